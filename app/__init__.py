@@ -20,9 +20,10 @@ def register_blueprints(app):
 
 
 def register_cli(app):
-    from app.cli import db_cli, plugin_cli
+    from app.cli import db_cli, log_cli, plugin_cli
 
     app.cli.add_command(db_cli)
+    app.cli.add_command(log_cli)
     app.cli.add_command(plugin_cli)
 
 
@@ -44,6 +45,12 @@ def init_socketio(app):
     socketio.init_app(app, cors_allowed_origins="*")
 
 
+def init_captcha(app):
+    from app.util.captcha import captcha_pool
+
+    captcha_pool.init_app(app)
+
+
 def load_app_config(app):
     """
     根据指定配置环境自动加载对应环境变量和配置类到app config
@@ -79,6 +86,7 @@ def create_app(register_all=True, **kwargs):
         register_api(app)
         apply_cors(app)
         init_socketio(app)
+        init_captcha(app)
         Lin(app, **kwargs)
         register_cli(app)
     return app
@@ -20,13 +20,14 @@ from app.lin import (
     manager,
     permission_meta,
 )
-from sqlalchemy import func
+from app.lin.export import stream_export
 
 from app.api import AuthorizationBearerSecurity, api
 from app.api.cms.schema import ResetPasswordSchema
 from app.api.cms.schema.admin import (
     AdminGroupListSchema,
     AdminGroupPermissionSchema,
+    AdminUserExportSchema,
     AdminUserPageSchema,
     AdminUserSchema,
     CreateGroupSchema,
@@ -72,22 +73,31 @@ def get_admin_users(query: QueryPageWithGroupIdSchema):
     )
     if g.group_id:
         query_group_id = query_group_id.filter(manager.group_model.id == g.group_id)
-    # 获取符合条件的用户总量
-    total = (
-        db.session.query(func.count(func.distinct(manager.user_group_model.user_id)))
-        .filter(manager.user_group_model.group_id.in_(query_group_id))
-        .scalar()
-    )
+    # 获取符合条件的用户总量，游标分页时只在首页计算
+    total = None
+    if not g.cursor:
+        total = (
+            db.session.query(manager.user_group_model.user_id)
+            .filter(manager.user_group_model.group_id.in_(query_group_id))
+            .distinct()
+            .total("cached")
+        )
     # 获取当前分页条件下查询到的非Root组的用户id
     query_current_page_user_ids = (
         db.session.query(manager.user_group_model.user_id)
         .filter(manager.user_group_model.group_id.in_(query_group_id))
         .group_by(manager.user_group_model.user_id)
-        .offset(g.offset)
-        .limit(g.count)
     )
+    next_cursor = None
+    if g.cursor is not None:
+        # 游标分页，按用户id升序
+        user_ids, next_cursor = query_current_page_user_ids.seek(
+            g.cursor, g.count, manager.user_group_model.user_id, desc=False
+        )
+    else:
+        user_ids = query_current_page_user_ids.offset(g.offset).limit(g.count).all()
     # 部分数据库不支持子语句 in limit
-    current_page_user_ids = [user_id[0] for user_id in query_current_page_user_ids.all()]
+    current_page_user_ids = [user_id[0] for user_id in user_ids]
     # 获取用户的基本信息
     current_page_users = manager.user_model.query.filter(manager.user_model.id.in_(current_page_user_ids)).all()
     # 获取需要填充分组的基本信息
@@ -117,6 +127,13 @@ def get_admin_users(query: QueryPageWithGroupIdSchema):
                     if ug.group_id == group.id:
                         item.groups.append(group)
 
+    if g.cursor is not None:
+        return {
+            "items": items,
+            "count": g.count,
+            "total": total,
+            "next_cursor": next_cursor,
+        }
     return {
         "items": items,
         "count": g.count,
@@ -126,6 +143,43 @@ def get_admin_users(query: QueryPageWithGroupIdSchema):
     }
 
 
+@admin_api.route("/users/export")
+@permission_meta(name="导出所有用户", module="管理员", mount=False)
+@admin_required
+@api.validate(
+    tags=["管理员"],
+    security=[AuthorizationBearerSecurity],
+)
+def export_admin_users(query: AdminUserExportSchema):
+    """
+    以 csv 或 jsonl 格式流式下载所有用户
+    """
+    query_group_id = db.session.query(manager.group_model.id).filter(
+        manager.group_model.level != GroupLevelEnum.ROOT.value
+    )
+    if g.group_id:
+        query_group_id = query_group_id.filter(manager.group_model.id == g.group_id)
+    users = (
+        db.session.query(
+            manager.user_model.id,
+            manager.user_model.username,
+            manager.user_model.nickname,
+            manager.user_model.email,
+            manager.user_model.create_time,
+        )
+        .filter(
+            manager.user_model.is_deleted == False,
+            manager.user_model.id.in_(
+                db.session.query(manager.user_group_model.user_id).filter(
+                    manager.user_group_model.group_id.in_(query_group_id)
+                )
+            ),
+        )
+        .order_by(manager.user_model.id)
+    )
+    return stream_export(users, format=g.format, filename="user")
+
+
 @admin_api.route("/user/<int:uid>/password", methods=["PUT"])
 @permission_meta(name="修改用户密码", module="管理员", mount=False)
 @admin_required
@@ -145,6 +199,7 @@ def change_user_password(uid: int, json: ResetPasswordSchema):
 
     with db.auto_commit():
         user.reset_password(g.new_password)
+        manager.evict_user(user.id)
 
     return Success("密码修改成功")
 
@@ -172,6 +227,8 @@ def delete_user(uid):
     with db.auto_commit():
         manager.user_group_model.query.filter_by(user_id=uid).delete(synchronize_session=False)
         user.hard_delete()
+        manager.evict_user(uid)
+        manager.invalidate_permissions()
     return Success("操作成功")
 
 
@@ -203,17 +260,13 @@ def update_user(uid: int, json: UpdateUserInfoSchema):
         group_ids = g.group_ids
         # 清空原来的所有关联关系
         manager.user_group_model.query.filter_by(user_id=user.id).delete(synchronize_session=False)
-        # 根据传入分组ids 新增关联记录
-        user_group_list = list()
         # 如果没传分组数据，则将其设定为 guest 分组
         if not group_ids:
             group_ids = [manager.group_model.get(level=GroupLevelEnum.GUEST.value).id]
-        for group_id in group_ids:
-            user_group = manager.user_group_model()
-            user_group.user_id = user.id
-            user_group.group_id = group_id
-            user_group_list.append(user_group)
-        db.session.add_all(user_group_list)
+        # 根据传入分组ids 新增关联记录
+        manager.user_group_model.create_many([dict(user_id=user.id, group_id=group_id) for group_id in group_ids])
+        manager.evict_user(user.id)
+        manager.invalidate_permissions()
     return Success("操作成功")
 
 
@@ -229,10 +282,14 @@ def get_all_group():
     """
     获取所有分组
     """
-    groups = manager.group_model.query.filter(
-        manager.group_model.is_deleted == False,
-        manager.group_model.level != GroupLevelEnum.ROOT.value,
-    ).all()
+    groups = (
+        manager.group_model.query.filter(
+            manager.group_model.is_deleted == False,
+            manager.group_model.level != GroupLevelEnum.ROOT.value,
+        )
+        .cached()
+        .all()
+    )
     if groups is None:
         raise NotFound("不存在任何分组")
     return groups
@@ -255,7 +312,7 @@ def get_group(gid):
         raise NotFound("分组不存在")
     permissions = manager.permission_model.select_by_group_id(gid)
     setattr(group, "permissions", permissions)
-    group._fields.append("permissions")
+    group.show("permissions")
     return group
 
 
@@ -284,13 +341,10 @@ def create_group(json: CreateGroupSchema):
             info=g.info,
         )
         db.session.flush()
-        group_permission_list = list()
-        for permission_id in g.permission_ids:
-            gp = manager.group_permission_model()
-            gp.group_id = group.id
-            gp.permission_id = permission_id
-            group_permission_list.append(gp)
-        db.session.add_all(group_permission_list)
+        manager.group_permission_model.create_many(
+            [dict(group_id=group.id, permission_id=permission_id) for permission_id in g.permission_ids]
+        )
+        manager.invalidate_permissions()
     return Success("新建分组成功")
 
 
@@ -343,6 +397,7 @@ def delete_group(gid):
         manager.group_permission_model.query.filter_by(group_id=gid).delete(synchronize_session=False)
         # 删除group
         exist.delete()
+        manager.invalidate_permissions()
     return Success("删除分组成功")
 
 
@@ -361,13 +416,22 @@ def dispatch_auths(json: GroupIdWithPermissionIdListSchema):
     分配多个权限
     """
     with db.auto_commit():
-        for permission_id in g.permission_ids:
-            one = manager.group_permission_model.get(group_id=g.group_id, permission_id=permission_id)
-            if not one:
-                manager.group_permission_model.create(
-                    group_id=g.group_id,
-                    permission_id=permission_id,
-                )
+        # 只写入分组尚未拥有的权限
+        existed = set(
+            permission_id
+            for permission_id, in db.session.query(manager.group_permission_model.permission_id).filter(
+                manager.group_permission_model.group_id == g.group_id,
+                manager.group_permission_model.permission_id.in_(g.permission_ids),
+            )
+        )
+        manager.group_permission_model.create_many(
+            [
+                dict(group_id=g.group_id, permission_id=permission_id)
+                for permission_id in dict.fromkeys(g.permission_ids)
+                if permission_id not in existed
+            ]
+        )
+        manager.invalidate_permissions()
     return Success("添加权限成功")
 
 
@@ -389,5 +453,6 @@ def remove_auths(json: GroupIdWithPermissionIdListSchema):
             manager.group_permission_model.permission_id.in_(g.permission_ids),
             manager.group_permission_model.group_id == g.group_id,
         ).delete(synchronize_session=False)
+        manager.invalidate_permissions()
 
     return Success("删除权限成功")
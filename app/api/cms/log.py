@@ -1,11 +1,22 @@
 import math
 
-from flask import Blueprint, g
+from flask import Blueprint, current_app, g
 from app.lin import DocResponse, Log, db, group_required, permission_meta
+from app.lin.export import stream_export
+from app.lin.log_search import log_search
+from app.lin.log_stats import log_stats
 from sqlalchemy import text
 
 from app.api import AuthorizationBearerSecurity, api
-from app.api.cms.schema.log import LogPageSchema, LogQuerySearchSchema, UsernameListSchema
+from app.api.cms.schema.log import (
+    LogExportSchema,
+    LogPageSchema,
+    LogQuerySearchSchema,
+    LogStatSchema,
+    LogStatsQuerySchema,
+    LogStatsSchema,
+    UsernameListSchema,
+)
 
 log_api = Blueprint("log", __name__)
 
@@ -23,18 +34,7 @@ def get_logs(query: LogQuerySearchSchema):
     """
     日志浏览查询（人员，时间, 关键字），分页展示
     """
-    logs = Log.query.filter()
-    total = logs.count()
-    items = logs.order_by(text("create_time desc")).offset(g.offset).limit(g.count).all()
-    total_page = math.ceil(total / g.count)
-
-    return LogPageSchema(
-        page=g.page,
-        count=g.count,
-        total=total,
-        items=items,
-        total_page=total_page,
-    )
+    return paginate_logs(Log.query.filter())
 
 
 @log_api.route("/search")
@@ -50,17 +50,88 @@ def search_logs(query: LogQuerySearchSchema):
     """
     日志搜索（人员，时间, 关键字），分页展示
     """
+    logs, score = filter_logs(Log.query)
+    # 按关键字检索时按相关度排序，游标分页仍按时间排序
+    return paginate_logs(logs, order=None if score is None else [score.desc(), Log.id.desc()], keyword=g.keyword)
+
+
+@log_api.route("/export")
+@permission_meta(name="导出日志", module="日志")
+@group_required
+@api.validate(
+    security=[AuthorizationBearerSecurity],
+    tags=["日志"],
+)
+def export_logs(query: LogExportSchema):
+    """
+    日志导出（人员，时间, 关键字），以 csv 或 jsonl 格式流式下载
+    """
+    logs, _ = filter_logs(
+        db.session.query(
+            Log.id,
+            Log.message,
+            Log.user_id,
+            Log.username,
+            Log.status_code,
+            Log.method,
+            Log.path,
+            Log.permission,
+            Log.create_time,
+        )
+    )
+    return stream_export(logs.order_by(Log.id.desc()), format=g.format, filename="log")
+
+
+@log_api.route("/stats")
+@permission_meta(name="查询日志统计", module="日志")
+@group_required
+@api.validate(
+    resp=DocResponse(r=LogStatsSchema),
+    security=[AuthorizationBearerSecurity],
+    tags=["日志"],
+)
+def get_log_stats(query: LogStatsQuerySchema):
+    """
+    按日、用户、权限或路径统计日志条数，读取按日汇总表，与日志总量无关
+    """
+    rows = log_stats.query(g.dimension, g.start, g.end, g.count)
+    return LogStatsSchema(
+        dimension=g.dimension,
+        items=[LogStatSchema(key=str(key), count=count) for key, count in rows],
+    )
+
+
+def filter_logs(logs):
+    """
+    按人员，时间, 关键字筛选日志，关键字使用全文索引检索
+    返回筛选后的查询及关键字的相关度，未按关键字检索时相关度为 None
+    """
+    score = None
     if g.keyword:
-        logs = Log.query.filter(Log.message.like(f"%{g.keyword}%"))
-    else:
-        logs = Log.query.filter()
+        logs, score = log_search.search(logs, g.keyword)
     if g.name:
         logs = logs.filter(Log.username == g.name)
     if g.start and g.end:
         logs = logs.filter(Log.create_time.between(g.start, g.end))
+    return logs, score
+
+
+def paginate_logs(logs, order=None, keyword=None):
+    """
+    按时间倒序分页，传入 cursor 时使用游标分页，查询代价与页数无关，总数只在首页计算
+    """
+    mode = count_mode(keyword)
+    if g.cursor is not None:
+        items, next_cursor = logs.seek(g.cursor, g.count, Log.create_time, Log.id)
+        return LogPageSchema(
+            count=g.count,
+            total=None if g.cursor else logs.total(mode),
+            items=items,
+            next_cursor=next_cursor,
+        )
 
-    total = logs.count()
-    items = logs.order_by(text("create_time desc")).offset(g.offset).limit(g.count).all()
+    total = logs.total(mode)
+    items = logs.order_by(*(order or [text("create_time desc")])).offset(g.offset).limit(g.count).all()
     total_page = math.ceil(total / g.count)
 
     return LogPageSchema(
@@ -72,6 +143,17 @@ def search_logs(query: LogQuerySearchSchema):
     )
 
 
+def count_mode(keyword=None):
+    """
+    日志总数的计数方式，CACHE["LOG_COUNT_MODE"] 为空时使用 CACHE["COUNT_MODE"]
+    执行计划对关键字检索(LIKE、MATCH)的行数估算没有意义，此时不使用估算值
+    """
+    mode = current_app.config.get("CACHE", dict()).get("LOG_COUNT_MODE")
+    if keyword and (mode or current_app.extensions["counter"].mode) == "estimate":
+        return "cached"
+    return mode
+
+
 @log_api.route("/users")
 @permission_meta(name="查询日志记录的用户", module="日志")
 @group_required
@@ -89,6 +171,7 @@ def get_users_for_log():
         .filter_by(soft=False)
         .group_by(text("username"))
         .having(text("count(username) > 0"))
+        .cached()
         .all()
     )
     return UsernameListSchema(items=[u.username for u in usernames])
@@ -3,7 +3,7 @@ from typing import List, Optional
 from app.lin import BaseModel, ParameterError
 from pydantic import Field, validator
 
-from app.schema import BasePageSchema, QueryPageSchema
+from app.schema import BasePageSchema, CursorPageSchema, ExportSchema, QueryCursorPageSchema
 
 from . import EmailSchema, GroupIdListSchema
 
@@ -24,11 +24,15 @@ class AdminUserSchema(EmailSchema):
     groups: List[AdminGroupSchema] = Field(description="用户组列表")
 
 
-class QueryPageWithGroupIdSchema(QueryPageSchema):
+class QueryPageWithGroupIdSchema(QueryCursorPageSchema):
     group_id: Optional[int] = Field(description="用户ID")
 
 
-class AdminUserPageSchema(BasePageSchema):
+class AdminUserExportSchema(ExportSchema):
+    group_id: Optional[int] = Field(description="用户组ID")
+
+
+class AdminUserPageSchema(CursorPageSchema):
     items: List[AdminUserSchema]
 
 
@@ -1,18 +1,18 @@
 import re
-from datetime import datetime
+from datetime import date, datetime
 from typing import List, Optional
 
 from app.lin import BaseModel
 from pydantic import Field, validator
 
-from app.schema import BasePageSchema, QueryPageSchema, datetime_regex
+from app.schema import CursorPageSchema, ExportSchema, QueryCursorPageSchema, datetime_regex
 
 
 class UsernameListSchema(BaseModel):
     items: List[str]
 
 
-class LogQuerySearchSchema(QueryPageSchema):
+class LogQuerySchema(BaseModel):
     keyword: Optional[str] = None
     name: Optional[str] = None
     start: Optional[str] = Field(None, description="YY-MM-DD HH:MM:SS")
@@ -25,6 +25,14 @@ class LogQuerySearchSchema(QueryPageSchema):
         raise ValueError("时间格式有误")
 
 
+class LogQuerySearchSchema(QueryCursorPageSchema, LogQuerySchema):
+    pass
+
+
+class LogExportSchema(ExportSchema, LogQuerySchema):
+    pass
+
+
 class LogSchema(BaseModel):
     message: str
     user_id: int
@@ -36,5 +44,22 @@ class LogSchema(BaseModel):
     time: datetime = Field(alias="create_time")
 
 
-class LogPageSchema(BasePageSchema):
+class LogPageSchema(CursorPageSchema):
     items: List[LogSchema]
+
+
+class LogStatsQuerySchema(BaseModel):
+    dimension: str = Field("day", regex="^(day|user|permission|path)$", description="统计维度 day、user、permission 或 path")
+    start: Optional[date] = Field(None, description="YY-MM-DD")
+    end: Optional[date] = Field(None, description="YY-MM-DD")
+    count: int = Field(10, gt=0, le=100, description="非 day 维度时按条数取前 count 个")
+
+
+class LogStatSchema(BaseModel):
+    key: str = Field(description="维度的值，day 维度为日期")
+    count: int
+
+
+class LogStatsSchema(BaseModel):
+    dimension: str
+    items: List[LogStatSchema]
@@ -18,6 +18,10 @@ class LoginTokenSchema(BaseModel):
     refresh_token: str = Field(description="refresh_token")
 
 
+class LogoutSchema(BaseModel):
+    refresh_token: Optional[str] = Field(description="一并注销的refresh_token")
+
+
 class CaptchaSchema(BaseModel):
     image: str = Field("", description="验证码图片base64编码")
     tag: str = Field("", description="验证码标记码")
@@ -9,7 +9,9 @@ from flask import Blueprint, current_app, g, request
 from flask_jwt_extended import (
     create_access_token,
     create_refresh_token,
+    decode_token,
     get_current_user,
+    get_jwt,
     get_jwt_identity,
     verify_jwt_in_request,
 )
@@ -17,18 +19,20 @@ from app.lin import (
     DocResponse,
     Duplicated,
     Failed,
-    Log,
     Logger,
     NotFound,
     ParameterError,
     Success,
     admin_required,
     db,
+    get_permission_claims,
     get_tokens,
     login_required,
     manager,
     permission_meta,
+    revoke_token,
 )
+from app.lin.log_writer import log_writer
 
 from app.api import AuthorizationBearerSecurity, api
 from app.api.cms.exception import RefreshFailed
@@ -37,11 +41,12 @@ from app.api.cms.schema.user import (
     ChangePasswordSchema,
     LoginSchema,
     LoginTokenSchema,
+    LogoutSchema,
     UserBaseInfoSchema,
     UserRegisterSchema,
     UserSchema,
 )
-from app.util.captcha import CaptchaTool
+from app.util.captcha import captcha_pool
 from app.util.common import split_group
 
 user_api = Blueprint("user", __name__)
@@ -80,11 +85,7 @@ def register(json: UserRegisterSchema):
             from app.lin import GroupLevelEnum
 
             group_ids = [GroupLevelEnum.GUEST.value]
-        for group_id in group_ids:
-            user_group = manager.user_group_model()
-            user_group.user_id = user.id
-            user_group.group_id = group_id
-            db.session.add(user_group)
+        manager.user_group_model.create_many([dict(user_id=user.id, group_id=group_id) for group_id in group_ids])
 
     return Success("用户创建成功")  # type: ignore
 
@@ -103,8 +104,10 @@ def login(json: LoginSchema):
             raise Failed("验证码校验失败")  # type: ignore
 
     user = manager.user_model.verify(g.username, g.password)
+    # 同步写入日志时会提交会话使 user 过期，先签发令牌避免重新加载
+    access_token, refresh_token = get_tokens(user)
     # 用户未登录，此处不能用装饰器记录日志
-    Log.create_log(
+    log_writer.write(
         message=f"{user.username}登录成功获取了令牌",
         user_id=user.id,
         username=user.username,
@@ -112,12 +115,37 @@ def login(json: LoginSchema):
         method="post",
         path="/cms/user/login",
         permission="",
-        commit=True,
     )
-    access_token, refresh_token = get_tokens(user)
     return LoginTokenSchema(access_token=access_token, refresh_token=refresh_token)
 
 
+@user_api.route("/logout", methods=["POST"])
+@permission_meta(name="注销", module="用户", mount=False)
+@login_required
+@api.validate(
+    tags=["用户"],
+    security=[AuthorizationBearerSecurity],
+    resp=DocResponse(Success("注销成功"), ParameterError("refresh_token未被识别")),
+)
+def logout(json: LogoutSchema):
+    """
+    注销当前令牌，可一并注销 refresh_token
+    """
+    payloads = [get_jwt()]
+    if g.refresh_token:
+        try:
+            payload = decode_token(g.refresh_token)
+        except Exception:
+            raise ParameterError("refresh_token未被识别")
+        if payload.get("type") != "refresh" or payload.get("uid") != get_current_user().id:
+            raise ParameterError("refresh_token未被识别")
+        payloads.append(payload)
+    with db.auto_commit():
+        for payload in payloads:
+            revoke_token(payload)
+    return Success("注销成功")  # type: ignore
+
+
 @user_api.route("", methods=["PUT"])
 @permission_meta(name="用户更新信息", module="用户", mount=False)
 @login_required
@@ -143,6 +171,7 @@ def update(json: UserBaseInfoSchema):
             user.nickname = g.nickname
         if g.avatar:
             user._avatar = g.avatar
+        manager.evict_user(user.id)
     return Success("用户信息更新成功")
 
 
@@ -162,6 +191,7 @@ def change_password(json: ChangePasswordSchema):
     user = get_current_user()
     ok = user.change_password(g.old_password, g.new_password)
     if ok:
+        manager.evict_user(user.id)
         db.session.commit()
         return Success("密码修改成功")
     else:
@@ -201,7 +231,13 @@ def refresh():
 
     identity = get_jwt_identity()
     if identity:
-        access_token = create_access_token(identity=identity)
+        # 旧的 refresh_token 只能使用一次
+        with db.auto_commit():
+            revoke_token(get_jwt())
+        access_token = create_access_token(
+            identity=identity,
+            additional_claims=get_permission_claims(identity["uid"]),
+        )
         refresh_token = create_refresh_token(identity=identity)
         return LoginTokenSchema(access_token=access_token, refresh_token=refresh_token)
 
@@ -228,7 +264,7 @@ def get_allowed_apis():
     res = split_group(permission_list, "module")
     setattr(user, "permissions", res)
     setattr(user, "admin", user.is_admin)
-    user._fields.extend(["admin", "permissions"])
+    user.show("admin", "permissions")
 
     return user
 
@@ -244,7 +280,7 @@ def get_captcha():
     """
     if not current_app.config.get("LOGIN_CAPTCHA"):
         return CaptchaSchema()  # type: ignore
-    image, code = CaptchaTool().get_verify_code()
+    image, code = captcha_pool.pop()
     secret_key = current_app.config.get("SECRET_KEY")
     tag = jwt.encode({"code": code}, secret_key, algorithm="HS256")
     return {"tag": tag, "image": image}
@@ -40,7 +40,7 @@ def get_books():
     """
     获取图书列表
     """
-    return Book.get(one=False)
+    return Book.query.filter_by(soft=True).cached().all()
 
 
 @book_api.route("/search")
@@ -52,7 +52,7 @@ def search(query: BookQuerySearchSchema):
     """
     关键字搜索图书
     """
-    return Book.query.filter(Book.title.like("%" + g.q + "%"), Book.is_deleted == False).all()
+    return Book.query.filter(Book.title.like("%" + g.q + "%"), Book.is_deleted == False).cached().all()
 
 
 @book_api.route("", methods=["POST"])
@@ -3,11 +3,15 @@ from flask.cli import AppGroup
 
 from .db import fake as _db_fake
 from .db import init as _db_init
+from .log import partition as _log_partition
+from .log import rebuild as _log_rebuild
+from .log import retain as _log_retain
 from .plugin import generate as _plugin_generate
 from .plugin import init as _plugin_init
 
 db_cli = AppGroup("db")
 plugin_cli = AppGroup("plugin")
+log_cli = AppGroup("log")
 
 
 @db_cli.command("init")
@@ -31,6 +35,50 @@ def db_fake():
     click.echo("fake数据添加成功")
 
 
+@db_cli.command("index")
+def db_index():
+    """
+    create the full-text index of logs.
+    """
+    from app.lin.log_search import log_search
+
+    try:
+        log_search.create_index()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo("日志全文索引建立成功")
+
+
+@log_cli.command("partition")
+def log_partition():
+    """
+    partition lin_log by month (MySQL/PostgreSQL).
+    """
+    _log_partition()
+    click.echo("日志分区建立成功")
+
+
+@log_cli.command("retain")
+@click.option("--months", type=int, help="Months of logs to keep.")
+def log_retain(months):
+    """
+    archive and delete expired logs.
+    """
+    _log_retain(months)
+    click.echo("过期日志归档成功")
+
+
+@log_cli.command("rebuild")
+@click.option("--start", type=click.DateTime(["%Y-%m-%d"]), help="First day to rebuild.")
+@click.option("--end", type=click.DateTime(["%Y-%m-%d"]), help="Last day to rebuild.")
+def log_rebuild(start, end):
+    """
+    rebuild log stats from lin_log.
+    """
+    _log_rebuild(start and start.date(), end and end.date())
+    click.echo("日志汇总重建成功")
+
+
 @plugin_cli.command("init", with_appcontext=False)
 def plugin_init():
     """
@@ -0,0 +1,3 @@
+from .partition import partition
+from .rebuild import rebuild
+from .retain import retain
@@ -0,0 +1,16 @@
+"""
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import click
+
+from app.lin.log_retention import log_retention
+
+
+def partition():
+    converted = not log_retention.is_partitioned()
+    months = log_retention.partition()
+    for month in months:
+        click.echo("建立分区 {0:%Y-%m}".format(month))
+    if converted and log_retention.dialect == "mysql":
+        click.echo("MySQL 的分区表不支持全文索引，已删除 lin_log 的全文索引，日志检索将使用 like，请重启服务")
@@ -0,0 +1,12 @@
+"""
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import click
+
+from app.lin.log_stats import log_stats
+
+
+def rebuild(start=None, end=None):
+    count = log_stats.rebuild(start, end)
+    click.echo("重建 {0} 条日志汇总".format(count))
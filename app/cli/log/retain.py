@@ -0,0 +1,14 @@
+"""
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import click
+
+from app.lin.log_retention import log_retention
+
+
+def retain(months=None):
+    if months is not None:
+        log_retention.months = months
+    for month, path, count in log_retention.retain():
+        click.echo("{0:%Y-%m} 归档 {1} 条日志至 {2}".format(month, count, path))
@@ -26,6 +26,15 @@ class BaseConfig(object):
         "sqlite:////" + os.getcwd() + os.path.sep + "lincms.db",
     )
 
+    # 只读副本，未写入的请求中的查询按轮询分发到健康的副本，多个地址以逗号分隔
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.getenv("SQLALCHEMY_REPLICA_URIS", "").split(",") if uri]
+    REPLICA = {
+        # 副本连通性的探测间隔(秒)
+        "PROBE_INTERVAL": 10,
+        # 副本不可用后暂停使用的时间(秒)，期间查询回退到主库
+        "RETRY_INTERVAL": 30,
+    }
+
     # 屏蔽 sql alchemy 的 FSADeprecationWarning
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
@@ -41,9 +50,32 @@ class BaseConfig(object):
 
     # 令牌配置
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=1)
+    # access token 中携带权限位图，group_required 可直接按位鉴权
+    JWT_PERMISSION_CLAIMS = False
+    # 令牌注销，各进程以布隆过滤器预判 jti 是否被注销
+    JWT_REVOCATION = {
+        # 布隆过滤器的初始容量及误判率
+        "CAPACITY": 100000,
+        "ERROR_RATE": 0.001,
+        # 每隔 PURGE_INTERVAL 秒清理一次已过期令牌的记录
+        "PURGE_INTERVAL": 3600,
+    }
+
+    # 密码哈希算法及迭代次数，调整后已有用户的密码将在下次登录成功时重新计算
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:260000"
+    PASSWORD_HASH_SALT_LENGTH = 16
+    # 计算密码哈希的线程数
+    PASSWORD_HASH_WORKERS = 4
 
     # 登录验证码
     LOGIN_CAPTCHA = False
+    # 预先生成的验证码池，SIZE 为 0 时每次请求当场生成
+    LOGIN_CAPTCHA_POOL = {
+        "SIZE": 200,
+        # 每隔 REFILL_INTERVAL 秒至多补充 REFILL_BATCH 个
+        "REFILL_INTERVAL": 1,
+        "REFILL_BATCH": 20,
+    }
 
     # 默认文件上传配置
     FILE = {
@@ -62,6 +94,81 @@ class BaseConfig(object):
         "SIZE_LIMIT": 1024 * 1024 * 5,
         "REQUEST_LOG": True,
         "FILE": True,
+        # 统计每个请求的 SQL 执行次数及耗时，记入请求日志，调试模式下附加到响应头
+        "SQL_PROFILE": True,
+        # 同一语句在一次请求中以不同参数执行的次数达到该值时视为 N+1 查询并告警
+        "N_PLUS_ONE": 5,
+        # 慢查询阈值(毫秒)，为 None 时不记录
+        "SLOW_QUERY": None,
+    }
+
+    # 行为日志的写入
+    LOG_WRITER = {
+        # 随请求同步写入并提交，测试时使用
+        "SYNC": False,
+        # 后台线程攒够 BATCH_SIZE 条或每隔 INTERVAL 秒批量写入一次
+        "BATCH_SIZE": 100,
+        "INTERVAL": 1,
+        # 队列已满时请求至多等待 BLOCK_TIMEOUT 秒，仍无空位则同步写入
+        "QUEUE_SIZE": 10000,
+        "BLOCK_TIMEOUT": 0.1,
+    }
+
+    # 日志检索
+    LOG_SEARCH = {
+        # auto 时使用已建立的全文索引(SQLite 的 FTS5 或 MySQL 的 ngram 全文索引)，
+        # 否则使用 like；也可指定 fts5、mysql、python(进程内倒排索引) 或 like
+        "BACKEND": "auto",
+        # 进程内倒排索引的候选超过该数量时直接使用 like，不超过 IN 的参数个数上限 900
+        "MAX_CANDIDATES": 900,
+        # 进程内倒排索引只索引最近的日志条数，更早的日志使用 like
+        "PYTHON_WINDOW": 100000,
+    }
+
+    # 日志的保留及归档，flask log retain 归档并删除过期的日志
+    LOG_RETENTION = {
+        # 保留最近 MONTHS 个月(含当月)的日志
+        "MONTHS": 6,
+        # 归档目录，每月一个 lin_log-YYYY-MM.jsonl.gz
+        "ARCHIVE_DIR": "archive",
+        # flask log partition 预先建立的月份分区数(MySQL/PostgreSQL)
+        "MONTHS_AHEAD": 3,
+        # 归档及删除时每批的行数
+        "BATCH_SIZE": 5000,
+    }
+
+    # 日志的按日汇总，写入日志时累加，供 /cms/log/stats 查询
+    LOG_STATS = {
+        # 关闭后不再累加，可通过 flask log rebuild 重建
+        "ENABLE": True,
+    }
+
+    # 多进程启动时依次同步权限表，避免同时写入
+    SYNC_PERMISSIONS_LOCK = True
+
+    # 进程内缓存配置
+    CACHE = {
+        # 多进程间缓存失效的轮询间隔(秒)
+        "SYNC_INTERVAL": 1,
+        # 用户快照缓存的容量及过期时间(秒)
+        "USER_SIZE": 1024,
+        "USER_TTL": 300,
+        # 已验证令牌的缓存容量，为 0 时每次请求都校验签名
+        "TOKEN_SIZE": 4096,
+        # 查询结果缓存，开启后 Query.cached() 生效
+        "QUERY_ENABLE": False,
+        "QUERY_SIZE": 1024,
+        "QUERY_TTL": 60,
+        # 分页总数缓存，开启后 Query.total 的 cached 计数方式生效
+        "COUNT_ENABLE": False,
+        # 默认的计数方式：exact、cached 或 estimate(MySQL/PostgreSQL 执行计划估算)
+        "COUNT_MODE": "exact",
+        "COUNT_SIZE": 1024,
+        "COUNT_TTL": 300,
+        # 估算的行数小于该值时仍精确计数
+        "COUNT_ESTIMATE_THRESHOLD": 10000,
+        # 日志列表的计数方式，为 None 时使用 COUNT_MODE；日志量大时可设为 estimate
+        "LOG_COUNT_MODE": None,
     }
 
     # 分页配置
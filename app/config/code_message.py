@@ -40,6 +40,7 @@ MESSAGE = {
     10040: "令牌失效",
     10041: "access token 损坏",
     10042: "refresh token 损坏",
+    10043: "令牌已注销",
     10050: "令牌过期",
     10051: "access token 过期",
     10052: "refresh token 过期",
@@ -3,6 +3,7 @@
     :license: MIT, see LICENSE for more details.
 """
 from .apidoc import BaseModel, DocResponse, SpecTree
+from .bus import bus
 from .config import global_config, lin_config
 from .db import db
 from .enums import GroupLevelEnum
@@ -30,7 +31,7 @@ from .exception import (
 from .file import Uploader
 from .form import Form
 from .interface import BaseCrud, InfoCrud
-from .jwt import admin_required, get_tokens, group_required, login_required
+from .jwt import admin_required, get_permission_claims, get_tokens, group_required, login_required, revoke_token
 from .lin import Lin
 from .logger import Log, Logger
 from .manager import manager
@@ -1,7 +1,7 @@
 import typing as t
 from functools import wraps
 
-from flask import Flask, current_app, g, json, jsonify, make_response
+from flask import Flask, current_app, g, json, jsonify
 from pydantic import BaseModel as _BaseModel
 from pydantic.main import object_setattr, validate_model
 from spectree import Response as _Response
@@ -313,7 +313,8 @@ def schema_response(app: Flask):
             and g._resp_schema
             and response.status_code == 200
         ):
-            response = make_response(
-                jsonify(g._resp_schema.parse_obj(response.get_json()))
+            # 替换响应体，保留其他 after_request 及视图设置的响应头
+            response.set_data(
+                jsonify(g._resp_schema.parse_obj(response.get_json())).get_data()
             )
         return response
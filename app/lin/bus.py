@@ -0,0 +1,128 @@
+"""
+    invalidation bus of Lin
+    ~~~~~~~~~
+
+    多进程(gunicorn worker)间的缓存失效通知
+
+    每个频道在 lin_generation 表中对应一个版本号，写操作在同一事务中递增版本号，
+    各进程定期轮询版本号，发现变化后清空本进程内对应的缓存
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import Column, Integer, String, event, select
+from sqlalchemy.exc import IntegrityError
+
+from .db import db
+from .interface import BaseCrud
+
+__all__ = ["Generation", "InvalidationBus", "bus"]
+
+PENDING_KEY = "lin_bus_pending"
+
+
+class Generation(BaseCrud):
+    __tablename__ = "lin_generation"
+
+    id = Column(Integer(), primary_key=True)
+    name = Column(String(100), nullable=False, unique=True, comment="频道名称")
+    version = Column(Integer(), nullable=False, default=0, comment="版本号")
+
+
+class InvalidationBus(object):
+    def __init__(self, app=None):
+        # 频道 -> 失效回调
+        self._callbacks = defaultdict(list)
+        # 本进程已知的频道版本号
+        self._versions = dict()
+        self._polled_at = 0.0
+        self._lock = threading.Lock()
+        self.interval = 1
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = app.config.get("CACHE", dict()).get("SYNC_INTERVAL", 1)
+        app.extensions["bus"] = self
+        app.before_request(self.poll)
+
+    def subscribe(self, channel, callback):
+        self._callbacks[channel].append(callback)
+
+    def version(self, channel) -> int:
+        return self._versions.get(channel, 0)
+
+    def publish(self, channel):
+        """
+        在当前会话的事务中递增频道版本号，随事务一同提交
+        提交成功后本进程立即失效，其他进程在下次轮询时失效
+        """
+        table = Generation.__table__
+        session = db.session()
+        self._update(session, channel, table.c.version + 1)
+        version = session.execute(select(table.c.version).where(table.c.name == channel)).scalar()
+        session.info.setdefault(PENDING_KEY, dict())[channel] = version
+
+    def lock(self, channel):
+        """
+        锁定频道所在的行直至当前事务结束，作为多进程间的互斥锁
+        不改变版本号
+        """
+        self._update(db.session(), channel, Generation.__table__.c.version)
+
+    @staticmethod
+    def _update(session, channel, version):
+        table = Generation.__table__
+        statement = table.update().where(table.c.name == channel).values(version=version)
+        if session.execute(statement).rowcount > 0:
+            return
+        try:
+            with session.begin_nested():
+                session.execute(table.insert().values(name=channel, version=1))
+        except IntegrityError:
+            # 其他进程已创建该频道
+            session.execute(statement)
+
+    def poll(self, force=False):
+        """读取所有频道的版本号，版本变化的频道触发失效回调，interval 秒内至多查询一次"""
+        now = time.monotonic()
+        if not force and now - self._polled_at < self.interval:
+            return
+        self._polled_at = now
+        rows = db.session.query(Generation.name, Generation.version).primary().all()
+        for name, version in rows:
+            self._apply(name, version)
+
+    def _apply(self, channel, version):
+        if self._versions.get(channel) == version:
+            return
+        # 先失效再记录版本号，使按版本号校验的数据只会偏旧而不会偏新
+        for callback in self._callbacks.get(channel, ()):
+            callback()
+        with self._lock:
+            self._versions[channel] = version
+
+
+bus = InvalidationBus()
+
+
+@event.listens_for(SignallingSession, "after_commit")
+def _apply_pending_channels(session):
+    if session.in_nested_transaction():
+        return
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending:
+        for channel, version in pending.items():
+            bus._apply(channel, version)
+
+
+@event.listens_for(SignallingSession, "after_rollback")
+def _discard_pending_channels(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop(PENDING_KEY, None)
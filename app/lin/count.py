@@ -0,0 +1,94 @@
+"""
+    count provider of Lin
+    ~~~~~~~~~
+
+    分页总数的计数方式，可按接口通过 Query.total(mode) 选择：
+
+    exact     每次执行 COUNT(*)
+    cached    以 SQL 及参数为键缓存精确的计数，所涉及的表被写入后失效(与查询缓存共用表的版本号)
+    estimate  MySQL/PostgreSQL 上取执行计划估算的行数，适用于不要求精确的大表；
+              估算值小于阈值或数据库不支持时按 cached 计数
+
+    cached 需开启 CACHE["COUNT_ENABLE"]，未开启时按 exact 计数
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import json
+
+from .cache import LRUCache
+from .query_cache import query_cache
+
+__all__ = ["COUNT_MODES", "CountProvider", "counter"]
+
+COUNT_MODES = ("exact", "cached", "estimate")
+
+
+class CountProvider(object):
+    def __init__(self, app=None):
+        self.enabled = False
+        self.mode = "exact"
+        self.threshold = 10000
+        self.store = LRUCache(1024, 300)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config.get("CACHE", dict())
+        self.enabled = config.get("COUNT_ENABLE", False)
+        self.mode = config.get("COUNT_MODE", self.mode)
+        self.threshold = config.get("COUNT_ESTIMATE_THRESHOLD", self.threshold)
+        self.store = LRUCache(config.get("COUNT_SIZE", 1024), config.get("COUNT_TTL", 300))
+        if self.enabled:
+            # 计数缓存依赖写操作递增表的版本号
+            query_cache.track_writes = True
+        app.extensions["counter"] = self
+
+    def count(self, query, mode=None) -> int:
+        mode = mode or self.mode
+        if mode not in COUNT_MODES:
+            raise ValueError("unknown count mode: {0}".format(mode))
+        if mode == "estimate":
+            estimate = self.estimate(query)
+            if estimate is not None and estimate >= self.threshold:
+                return estimate
+            mode = "cached"
+        if mode == "cached" and self.enabled:
+            return self._cached(query)
+        return query.count()
+
+    def _cached(self, query) -> int:
+        key = query_cache.key(query.session, query.statement)
+        if key is None:
+            return query.count()
+        total = self.store.get(key)
+        if total is None:
+            total = query.count()
+            self.store.set(key, total)
+        return total
+
+    @staticmethod
+    def estimate(query):
+        """执行计划估算的结果行数，数据库不支持时返回 None"""
+        statement = query.statement
+        connection = query.session.connection(bind_arguments={"clause": statement})
+        dialect = connection.dialect
+        if dialect.name not in ("mysql", "postgresql"):
+            return None
+        compiled = statement.compile(dialect=dialect)
+        params = compiled.params
+        if compiled.positional:
+            params = tuple(params[name] for name in compiled.positiontup)
+        if dialect.name == "postgresql":
+            plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), params).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]["Plan"]["Plan Rows"])
+        # MySQL 取首个表的扫描行数乘以过滤比例
+        row = connection.exec_driver_sql("EXPLAIN " + str(compiled), params).mappings().first()
+        if row is None or row.get("rows") is None:
+            return 0
+        return int(row["rows"] * float(row.get("filtered") or 100) / 100)
+
+
+counter = CountProvider()
@@ -4,20 +4,32 @@
     :copyright: © 2020 by the Lin team.
     :license: MIT, see LICENSE for more details.
 """
+import base64
 import os
+import threading
+import time
+from array import array
 from collections import OrderedDict
 from contextlib import contextmanager
+from datetime import date, datetime, timezone
 from inspect import isclass
+from itertools import islice
 
 import tablib
-from flask import json
+from flask import current_app, json
 from flask_sqlalchemy import BaseQuery
 from flask_sqlalchemy import Model as _Model
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import exc, func, inspect, orm, text
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import and_, event, exc, inspect, or_, orm, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.pool import QueuePool
 
-from .exception import NotFound
+from .exception import NotFound, ParameterError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class MixinJSONSerializer:
@@ -33,14 +45,36 @@ class MixinJSONSerializer:
         pass
 
     def __prune_fields(self):
-        columns = inspect(self.__class__).columns  # type: ignore
         if not self._fields:
-            all_columns = set([column.name for column in columns])
-            self._fields = list(all_columns - set(self._exclude))
+            # 同类实例共享同一个字段元组，修改前需复制
+            self._fields = self._default_fields(tuple(self._exclude))
+
+    @classmethod
+    def _default_fields(cls, exclude) -> tuple:
+        """按类缓存除 exclude 外的所有列名，exclude 改变时重新计算"""
+        cached = cls.__dict__.get("_lin_default_fields")
+        if cached is None or cached[0] != exclude:
+            columns = inspect(cls).columns  # type: ignore
+            fields = tuple(
+                OrderedDict.fromkeys(
+                    column.name for column in columns if column.name not in exclude
+                )
+            )
+            cached = (exclude, fields)
+            # 不能写在父类上，否则子类会读到父类的缓存
+            setattr(cls, "_lin_default_fields", cached)
+        return cached[1]
 
     def hide(self, *args):
+        fields = list(self._fields)
         for key in args:
-            self._fields.remove(key)
+            fields.remove(key)
+        self._fields = fields
+        return self
+
+    def show(self, *args):
+        """追加需要序列化的属性"""
+        self._fields = list(self._fields) + list(args)
         return self
 
     def keys(self):
@@ -52,21 +86,35 @@ class MixinJSONSerializer:
         return getattr(self, key)
 
 
+class RecordSchema(object):
+    """Column names of a result set, shared by all of its Records."""
+
+    __slots__ = ("keys", "index")
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        # 列名 -> 下标，重名的列映射为 None
+        self.index = dict()
+        for i, key in enumerate(self.keys):
+            self.index[key] = None if key in self.index else i
+
+
 class Record(object):
     """A row, from a query, from a database."""
 
-    __slots__ = ("_keys", "_values")
+    __slots__ = ("_schema", "_values")
 
     def __init__(self, keys, values):
-        self._keys = keys
+        if not isinstance(keys, RecordSchema):
+            keys = RecordSchema(keys)
+            # Ensure that lengths match properly.
+            assert len(keys.keys) == len(values)
+        self._schema = keys
         self._values = values
 
-        # Ensure that lengths match properly.
-        assert len(self._keys) == len(self._values)
-
     def keys(self):
         """Returns the list of column names from the query."""
-        return self._keys
+        return self._schema.keys
 
     def values(self):
         """Returns the list of values from the query."""
@@ -78,16 +126,15 @@ class Record(object):
     def __getitem__(self, key):
         # Support for index-based lookup.
         if isinstance(key, int):
-            return self.values()[key]
+            return self._values[key]
 
         # Support for string-based lookup.
-        if key in self.keys():
-            i = self.keys().index(key)
-            if self.keys().count(key) > 1:
-                raise KeyError("Record contains multiple '{}' fields.".format(key))
-            return self.values()[i]
-
-        raise KeyError("Record contains no '{}' field.".format(key))
+        i = self._schema.index.get(key, -1)
+        if i is None:
+            raise KeyError("Record contains multiple '{}' fields.".format(key))
+        if i < 0:
+            raise KeyError("Record contains no '{}' field.".format(key))
+        return self._values[i]
 
     def __getattr__(self, key):
         try:
@@ -132,17 +179,45 @@ class Record(object):
 class RecordCollection(object):
     """A set of excellent Records from a query."""
 
-    def __init__(self, rows):
+    def __init__(self, rows, close=None, stream=False, cursor=None, schema=None):
         self._rows = rows
         self._all_rows = []
         self.pending = True
+        # 结果集耗尽或关闭时调用，释放游标及连接
+        self._close = close
+        # 流式结果集不缓存已读取的行，只能遍历一次
+        self.stream = stream
+        # 按列导出时直接从游标批量读取
+        self._cursor = cursor
+        self._schema = schema
 
     def __repr__(self):
         return "<RecordCollection size={} pending={}>".format(len(self), self.pending)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, val, traceback):
+        self.close()
+
+    def close(self):
+        """Releases the underlying cursor and connection. Unread rows are
+        discarded."""
+        self.pending = False
+        close, self._close = self._close, None
+        if close is not None:
+            close()
+
     def __iter__(self):
         """Iterate over all rows, consuming the underlying generator
         only when necessary."""
+        if self.stream:
+            while True:
+                try:
+                    yield next(self)
+                except StopIteration:
+                    return
+
         i = 0
         while True:
             # Other code may have iterated between yields,
@@ -162,15 +237,25 @@ class RecordCollection(object):
         return self.__next__()
 
     def __next__(self):
+        if not self.pending:
+            raise StopIteration("RecordCollection contains no more rows.")
         try:
             nextrow = next(self._rows)
-            self._all_rows.append(nextrow)
-            return nextrow
         except StopIteration:
-            self.pending = False
+            self.close()
             raise StopIteration("RecordCollection contains no more rows.")
+        except Exception:
+            self.close()
+            raise
+        if not self.stream:
+            self._all_rows.append(nextrow)
+        return nextrow
 
     def __getitem__(self, key):
+        if self.stream:
+            raise RecordsException(
+                "Streamed RecordCollection does not support indexing, iterate it."
+            )
         is_int = isinstance(key, int)
 
         # Convert RecordCollection[1] into slice.
@@ -279,12 +364,70 @@ class RecordCollection(object):
         row = self.one()
         return row[0] if row else default
 
+    def to_columns(self, batch_size=1000):
+        """Returns an OrderedDict of column name -> column values. Numeric
+        columns are stored in typed ``array.array``, others in lists.
+        Streamed collections are read from the cursor with fetchmany and
+        consumed."""
+        keys = self.keys()
+        if keys is None:
+            return OrderedDict()
+        if len(set(keys)) != len(keys):
+            raise RecordsException("Columns of RecordCollection must be unique.")
+        builders = [_ColumnBuilder() for _ in keys]
+        for batch in self.batches(batch_size):
+            for builder, values in zip(builders, zip(*batch)):
+                builder.extend(values)
+        return OrderedDict(
+            (key, builder.values if builder.values is not None else [])
+            for key, builder in zip(keys, builders)
+        )
+
+    def to_numpy(self, batch_size=1000):
+        """Like to_columns, but returns numpy arrays. Datetime columns are
+        converted to datetime64 (in UTC when timezone-aware)."""
+        if numpy is None:
+            raise RecordsException("to_numpy requires numpy to be installed.")
+        return OrderedDict(
+            (key, _to_ndarray(values))
+            for key, values in self.to_columns(batch_size).items()
+        )
+
+    def keys(self):
+        """Returns the column names, or None if they are unknown."""
+        if self._schema is not None:
+            return self._schema.keys
+        first = self.first() if not self.stream else None
+        return list(first.keys()) if first is not None else None
+
+    def batches(self, batch_size=1000):
+        """Yields the remaining rows as lists of at most batch_size tuples.
+        Streamed collections are read from the cursor with fetchmany and
+        released when exhausted."""
+        if not self.stream or self._cursor is None:
+            rows = iter(self) if self.stream else iter(self.all())
+            while True:
+                batch = [row.values() for row in islice(rows, batch_size)]
+                if not batch:
+                    return
+                yield batch
+        try:
+            while self.pending:
+                batch = self._cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            self.close()
+
 
 class Connection(object):
     """A Database connection."""
 
-    def __init__(self, connection):
+    def __init__(self, connection, close_with_results=False):
         self._conn = connection
+        # 由 Database.query 创建的连接随结果集关闭
+        self._close_with_results = close_with_results
 
     def close(self):
         self._conn.close()
@@ -298,20 +441,40 @@ class Connection(object):
     def __repr__(self):
         return "<Connection open={}>".format(not self._conn.closed)
 
-    def query(self, query, fetchall=False, **params):
+    def query(self, query, fetchall=False, stream=False, yield_per=1000, **params):
         """Executes the given SQL query against the connected Database.
         Parameters can, optionally, be provided. Returns a RecordCollection,
         which can be iterated over to get result rows as dictionaries.
+
+        The query may be a SQL string or a SQLAlchemy selectable.
+        With stream=True rows are read through a server-side cursor in
+        batches of yield_per and are not cached by the RecordCollection.
         """
 
         # Execute the given query.
-        cursor = self._conn.execute(text(query), **params)  # TODO: PARAMS GO HERE
-
-        # Row-by-row Record generator.
-        row_gen = (Record(cursor.keys(), row) for row in cursor)
+        conn = self._conn
+        if stream:
+            conn = conn.execution_options(stream_results=True)
+        if isinstance(query, str):
+            query = text(query)
+        cursor = conn.execute(query, **params)  # TODO: PARAMS GO HERE
+        if stream:
+            cursor = cursor.yield_per(yield_per)
+
+        # Row-by-row Record generator, all rows share one schema.
+        schema = RecordSchema(cursor.keys())
+        row_gen = (Record(schema, row) for row in cursor)
+
+        # 结果集读取完毕或关闭时释放游标，连接归本结果集所有时一并归还连接池
+        def close():
+            cursor.close()
+            if self._close_with_results:
+                self.close()
 
         # Convert psycopg2 results to RecordCollection.
-        results = RecordCollection(row_gen)
+        results = RecordCollection(
+            row_gen, close=close, stream=stream, cursor=cursor, schema=schema
+        )
 
         # Fetch all results if desired.
         if fetchall:
@@ -324,7 +487,7 @@ class Connection(object):
 
         self._conn.execute(text(query), *multiparams)
 
-    def query_file(self, path, fetchall=False, **params):
+    def query_file(self, path, fetchall=False, stream=False, **params):
         """Like Connection.query, but takes a filename to load a query from."""
 
         # If path doesn't exists
@@ -340,7 +503,7 @@ class Connection(object):
             query = f.read()
 
         # Defer processing to self.query method.
-        return self.query(query=query, fetchall=fetchall, **params)
+        return self.query(query=query, fetchall=fetchall, stream=stream, **params)
 
     def bulk_query_file(self, path, *multiparams):
         """Like Connection.bulk_query, but takes a filename to load a query
@@ -374,11 +537,133 @@ class RecordsException(Exception):
     pass
 
 
+# 会话已写入或处于 auto_commit 中，此后的查询都使用主库
+PRIMARY_KEY = "lin_primary"
+
+
+class ReplicaSet(object):
+    """
+    只读副本，按轮询选择健康的副本
+
+    每个副本至多 probe_interval 秒探测一次连通性，探测失败或连接断开后
+    retry_interval 秒内不再使用；没有健康的副本时 choose 返回 None，由调用方回退到主库
+    """
+
+    def __init__(self, engines, probe_interval=10, retry_interval=30):
+        self.engines = list(engines)
+        self.probe_interval = probe_interval
+        self.retry_interval = retry_interval
+        self._probed_at = [0.0] * len(self.engines)
+        self._down_until = [0.0] * len(self.engines)
+        self._next = 0
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, "handle_error", self._handle_error)
+
+    def choose(self):
+        for _ in range(len(self.engines)):
+            # 并发下偶尔选中同一副本无碍
+            self._next = index = (self._next + 1) % len(self.engines)
+            if self._healthy(index):
+                return self.engines[index]
+        return None
+
+    def _healthy(self, index) -> bool:
+        now = time.monotonic()
+        if now < self._down_until[index]:
+            return False
+        with self._lock:
+            if now - self._probed_at[index] < self.probe_interval:
+                return True
+            self._probed_at[index] = now
+        try:
+            with self.engines[index].connect() as conn:
+                conn.exec_driver_sql("SELECT 1")
+        except exc.DBAPIError:
+            self._mark_down(index)
+            return False
+        return True
+
+    def _mark_down(self, index):
+        self._down_until[index] = time.monotonic() + self.retry_interval
+
+    def _handle_error(self, context):
+        if context.is_disconnect and context.engine in self.engines:
+            self._mark_down(self.engines.index(context.engine))
+
+    def __len__(self):
+        return len(self.engines)
+
+
+class Session(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        # SQLAlchemy 1.4 会传入 bind、_sa_skip_events 等参数
+        if self._use_replica(mapper, clause):
+            replica = self.app.extensions["replicas"].choose()
+            if replica is not None:
+                return replica
+        return super(Session, self).get_bind(mapper, clause)
+
+    def _use_replica(self, mapper, clause) -> bool:
+        """未写入且不在 auto_commit 中的普通查询读副本"""
+        if self.info.get(PRIMARY_KEY) or not self.app.extensions.get("replicas"):
+            return False
+        if clause is None or not getattr(clause, "is_select", False):
+            return False
+        if clause.get_execution_options().get("lin_primary"):
+            return False
+        if getattr(clause, "_for_update_arg", None) is not None:
+            return False
+        # 通过 __bind_key__ 绑定到其他数据库的模型
+        if mapper is not None and mapper.persist_selectable.info.get("bind_key"):
+            return False
+        return True
+
+    def pin(self):
+        """此后会话中的查询都使用主库，直至会话结束(请求结束时)"""
+        self.info[PRIMARY_KEY] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _pin_on_write(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.pin()
+
+
+@event.listens_for(Session, "after_flush")
+def _pin_on_flush(session, flush_context):
+    session.pin()
+
+
 class Database(SQLAlchemy):
     def __init__(self, **kwargs):
         self.open = True
         super(Database, self).__init__(**kwargs)
 
+    def init_app(self, app):
+        super(Database, self).init_app(app)
+        app.config.setdefault("SQLALCHEMY_REPLICA_URIS", [])
+        config = app.config.get("REPLICA", dict())
+        app.extensions["replicas"] = ReplicaSet(
+            [
+                self.create_replica_engine(app, uri)
+                for uri in app.config["SQLALCHEMY_REPLICA_URIS"]
+            ],
+            probe_interval=config.get("PROBE_INTERVAL", 10),
+            retry_interval=config.get("RETRY_INTERVAL", 30),
+        )
+
+    def create_replica_engine(self, app, uri):
+        """按主库相同的引擎配置创建副本的引擎"""
+        options = self.apply_pool_defaults(app, dict())
+        sa_url, options = self.apply_driver_hacks(app, make_url(uri), options)
+        options.update(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        options.update(self._engine_options)
+        return self.create_engine(sa_url, options)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=Session, db=self, **options)
+
     @property
     def dialect(self):
         return self.engine.dialect.name
@@ -421,41 +706,60 @@ class Database(SQLAlchemy):
         # Setup SQLAlchemy for Database inspection.
         return inspect(self.engine).get_table_names()
 
-    def get_connection(self):
+    def get_connection(self, close_with_results=False):
         """Get a connection to this Database. Connections are retrieved from a
-        pool. The retrieved connection remains open until its result is
-        consumed.
+        pool. The retrieved connection remains open until it is closed, or
+        with close_with_results=True, until its result is consumed or closed.
         """
         if not self.open:
             raise exc.ResourceClosedError("Database closed.")
 
-        return Connection(self.engine.connect())
+        return Connection(self.engine.connect(), close_with_results)
 
-    def query(self, query, fetchall=False, **params):
+    def query(self, query, fetchall=False, stream=False, yield_per=1000, **params):
         """Executes the given SQL query against the Database. Parameters can,
         optionally, be provided. Returns a RecordCollection, which can be
         iterated over to get result rows as dictionaries.
+
+        By default all rows are fetched and the connection is returned to the
+        pool immediately. With stream=True rows are read lazily through a
+        server-side cursor, and the connection is returned once the
+        RecordCollection is exhausted or closed, e.g.:
+
+            with db.query(sql, stream=True) as rows:
+                for row in rows:
+                    ...
         """
-        conn = self.get_connection()
-        return conn.query(query, fetchall, **params)
+        conn = self.get_connection(close_with_results=True)
+        try:
+            return conn.query(
+                query, fetchall or not stream, stream, yield_per, **params
+            )
+        except Exception:
+            conn.close()
+            raise
 
     def bulk_query(self, query, *multiparams):
         """Bulk insert or update."""
 
-        conn = self.get_connection()
-        conn.bulk_query(query, *multiparams)
+        with self.get_connection() as conn:
+            conn.bulk_query(query, *multiparams)
 
-    def query_file(self, path, fetchall=False, **params):
+    def query_file(self, path, fetchall=False, stream=False, **params):
         """Like Database.query, but takes a filename to load a query from."""
 
-        conn = self.get_connection()
-        return conn.query_file(path, fetchall, **params)
+        conn = self.get_connection(close_with_results=True)
+        try:
+            return conn.query_file(path, fetchall or not stream, stream, **params)
+        except Exception:
+            conn.close()
+            raise
 
     def bulk_query_file(self, path, *multiparams):
         """Like Database.bulk_query, but takes a filename to load a query from."""
 
-        conn = self.get_connection()
-        conn.bulk_query_file(path, *multiparams)
+        with self.get_connection() as conn:
+            conn.bulk_query_file(path, *multiparams)
 
     @contextmanager
     def transaction(self):
@@ -474,6 +778,8 @@ class Database(SQLAlchemy):
 
     @contextmanager
     def auto_commit(self):
+        # 事务中需读到最新的数据
+        self.session().pin()
         try:
             yield
             self.session.commit()
@@ -501,6 +807,44 @@ class Query(BaseQuery):
             raise NotFound()
         return rv
 
+    def seek(self, cursor, count, *columns, desc=True):
+        """
+        游标分页(keyset)，按 columns 排序并从 cursor 之后开始取 count 条，
+        查询代价与页数无关；columns 的组合需唯一，通常以主键结尾
+        cursor 为空时返回第一页
+        返回 (items, next_cursor)，没有更多数据时 next_cursor 为 None
+        """
+        query = self
+        if cursor:
+            values = decode_cursor(cursor, len(columns))
+            query = query.filter(_seek_condition(columns, values, desc))
+        order = [c.desc() if desc else c.asc() for c in columns]
+        # 多取一条以判断是否还有下一页
+        items = query.order_by(*order).limit(count + 1).all()
+        if len(items) <= count:
+            return items, None
+        items = items[:count]
+        last = items[-1]
+        return items, encode_cursor([getattr(last, c.key) for c in columns])
+
+    def primary(self):
+        """强制从主库读取，用于不能容忍副本延迟的查询"""
+        return self.execution_options(lin_primary=True)
+
+    def total(self, mode=None) -> int:
+        """
+        查询结果的总数，mode 为 exact、cached 或 estimate，详见 count.py
+        mode 为 None 时使用 CACHE["COUNT_MODE"]
+        """
+        return current_app.extensions["counter"].count(self, mode)
+
+    def cached(self, ttl=None):
+        """
+        缓存查询结果，涉及的表被写入后自动失效，需开启 CACHE["QUERY_ENABLE"]
+        ttl 为 None 时使用 CACHE["QUERY_TTL"]
+        """
+        return self.execution_options(lin_cache=True, lin_cache_ttl=ttl)
+
 
 class Model(_Model):
     def __repr__(self):
@@ -515,6 +859,49 @@ class Model(_Model):
         return "\n<{0} {1} {2}>\n".format(type(self).__name__, pk, detail)
 
 
+def encode_cursor(values) -> str:
+    """将排序列的取值编码为不透明的游标"""
+    values = [
+        {"$dt": value.isoformat()} if isinstance(value, datetime) else value
+        for value in values
+    ]
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, length) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw.decode("utf-8"))
+    except ValueError:
+        raise ParameterError("cursor 无效")  # type: ignore
+    if not isinstance(values, list) or len(values) != length:
+        raise ParameterError("cursor 无效")  # type: ignore
+    return [_decode_cursor_value(value) for value in values]
+
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict):
+        if not isinstance(value.get("$dt"), str):
+            raise ParameterError("cursor 无效")  # type: ignore
+        try:
+            return datetime.fromisoformat(value["$dt"])
+        except ValueError:
+            raise ParameterError("cursor 无效")  # type: ignore
+    if not isinstance(value, (str, int, float)):
+        raise ParameterError("cursor 无效")  # type: ignore
+    return value
+
+
+def _seek_condition(columns, values, desc):
+    """(a, b) < (x, y) 展开为 a < x or (a = x and b < y)，以兼容各数据库及利用索引"""
+    conditions = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        equals = [c == v for c, v in zip(columns[:i], values[:i])]
+        conditions.append(and_(*equals, column < value if desc else column > value))
+    return or_(*conditions)
+
+
 def isexception(obj):
     """Given an object, return a boolean indicating whether it is an instance
     or subclass of :py:class:`Exception`.
@@ -526,6 +913,51 @@ def isexception(obj):
     return False
 
 
+class _ColumnBuilder(object):
+    """Collects the values of one column, typed by the first non-null value."""
+
+    __slots__ = ("values",)
+
+    TYPECODES = {bool: "b", int: "q", float: "d"}
+
+    def __init__(self):
+        self.values = None
+
+    def extend(self, values):
+        if self.values is None:
+            typecode = None
+            for value in values:
+                if value is not None:
+                    typecode = self.TYPECODES.get(type(value))
+                    break
+            self.values = array(typecode) if typecode else []
+        if isinstance(self.values, array):
+            try:
+                self.values += array(self.values.typecode, values)
+                return
+            except (TypeError, OverflowError):
+                # 出现空值或超出范围的值，退化为列表
+                self.values = self.values.tolist()
+        self.values.extend(values)
+
+
+def _to_ndarray(values):
+    if isinstance(values, array):
+        return numpy.frombuffer(values, dtype=values.typecode)
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, datetime):
+        values = [
+            value.astimezone(timezone.utc).replace(tzinfo=None)
+            if value is not None and value.tzinfo is not None
+            else value
+            for value in values
+        ]
+        return numpy.array(values, dtype="datetime64[us]")
+    if isinstance(sample, date):
+        return numpy.array(values, dtype="datetime64[D]")
+    return numpy.array(values, dtype=object)
+
+
 def _reduce_datetimes(row):
     """Receives a row, converts datetimes to strings."""
 
@@ -537,17 +969,11 @@ def _reduce_datetimes(row):
     return tuple(row)
 
 
-def get_total_nums(cls, is_soft=False, **kwargs):
-    nums = db.session.query(func.count(cls.id))
-    nums = (
-        nums.filter(cls.is_deleted == False).filter_by(**kwargs).scalar()
-        if is_soft
-        else nums.filter().scalar()
-    )
-    if nums:
-        return nums
-    else:
-        return 0
+def get_total_nums(cls, is_soft=False, mode=None, **kwargs):
+    query = db.session.query(cls.id)
+    if is_soft:
+        query = query.filter(cls.is_deleted == False).filter_by(**kwargs)
+    return query.total(mode)
 
 
 def to_str(x, charset="utf8", errors="strict"):
@@ -0,0 +1,86 @@
+"""
+    export of Lin
+    ~~~~~~~~~
+
+    将查询结果以 CSV 或 JSON Lines 流式输出，按批次从服务端游标读取并写出，
+    内存占用与结果集大小无关
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import csv
+import io
+import json
+from urllib.parse import quote
+
+from flask import Response, current_app, stream_with_context
+
+from .db import db
+from .exception import ParameterError
+
+__all__ = ["stream_export", "EXPORT_FORMATS"]
+
+# 格式 -> (mimetype, 扩展名)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+}
+
+
+def stream_export(query, format="csv", filename="export", batch_size=1000, **params):
+    """
+    以流式响应导出查询结果
+    :param query: SQL 语句、SQLAlchemy 的 select 或 ORM Query
+    :param format: csv 或 jsonl
+    :param filename: 下载的文件名(不含扩展名)
+    :param batch_size: 每批从游标读取并写出的行数
+    :param params: SQL 语句的参数
+    """
+    if format not in EXPORT_FORMATS:
+        raise ParameterError("不支持的导出格式")  # type: ignore
+    mimetype, extension = EXPORT_FORMATS[format]
+    if hasattr(query, "statement"):
+        query = query.statement
+    writer = _write_csv if format == "csv" else _write_jsonl
+
+    def generate():
+        with db.query(query, stream=True, yield_per=batch_size, **params) as rows:
+            yield from writer(rows, batch_size)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": "attachment; filename*=UTF-8''{}".format(quote("{}.{}".format(filename, extension)))
+        },
+    )
+
+
+def _write_csv(rows, batch_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM 使 Excel 以 UTF-8 打开
+    buffer.write("\ufeff")
+    writer.writerow(rows.keys())
+    for batch in rows.batches(batch_size):
+        writer.writerows(_isoformat(row) for row in batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _write_jsonl(rows, batch_size):
+    keys = rows.keys()
+    # 保持列的顺序，不使用 flask.json 的 sort_keys
+    encoder = current_app.json_encoder
+    for batch in rows.batches(batch_size):
+        # 时间与 csv 一致输出为 ISO 8601 字符串
+        yield "".join(
+            json.dumps(dict(zip(keys, _isoformat(row))), cls=encoder, ensure_ascii=False) + "\n" for row in batch
+        ).encode("utf-8")
+
+
+def _isoformat(row):
+    return [value.isoformat() if hasattr(value, "isoformat") else value for value in row]
@@ -9,6 +9,7 @@
     :license: MIT, see LICENSE for more details.
 """
 from datetime import datetime
+from itertools import groupby, islice
 
 from sqlalchemy import (
     Boolean,
@@ -18,9 +19,15 @@ from sqlalchemy import (
     Integer,
     SmallInteger,
     String,
+    and_,
+    bindparam,
     func,
+    inspect,
+    select,
     text,
+    tuple_,
 )
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 
 from .db import MixinJSONSerializer, db
 from .enums import GroupLevelEnum
@@ -78,6 +85,21 @@ class BaseCrud(db.Model, MixinJSONSerializer):
             db.session.commit()
         return self
 
+    # 批量增
+    @classmethod
+    def create_many(cls, rows, chunk_size=1000, return_pk=False):
+        return _create_many(cls, rows, chunk_size, return_pk)
+
+    # 批量改，每行需带有主键
+    @classmethod
+    def update_many(cls, rows, chunk_size=1000):
+        _update_many(cls, rows, chunk_size)
+
+    # 批量增或改
+    @classmethod
+    def upsert_many(cls, rows, index_elements=None, chunk_size=1000):
+        _upsert_many(cls, rows, index_elements, chunk_size)
+
 
 # 提供软删除，及创建时间，更新时间信息的crud model
 
@@ -156,6 +178,21 @@ class InfoCrud(db.Model, MixinJSONSerializer):
             db.session.commit()
         return self
 
+    # 批量增
+    @classmethod
+    def create_many(cls, rows, chunk_size=1000, return_pk=False):
+        return _create_many(cls, rows, chunk_size, return_pk)
+
+    # 批量改，每行需带有主键
+    @classmethod
+    def update_many(cls, rows, chunk_size=1000):
+        _update_many(cls, rows, chunk_size)
+
+    # 批量增或改
+    @classmethod
+    def upsert_many(cls, rows, index_elements=None, chunk_size=1000):
+        _upsert_many(cls, rows, index_elements, chunk_size)
+
 
 class GroupInterface(InfoCrud):
     __tablename__ = "lin_group"
@@ -245,6 +282,10 @@ class UserInterface(InfoCrud):
     def check_password(self, raw):
         raise NotImplementedError()
 
+    @classmethod
+    def get_with_details(cls, **kwargs) -> InfoCrud:
+        raise NotImplementedError()
+
     @classmethod
     def verify(cls, username, password) -> InfoCrud:
         raise NotImplementedError()
@@ -276,3 +317,168 @@ class LinViewModel:
 
     def __getitem__(self, key):
         return getattr(self, key)
+
+
+def _column_names(cls) -> dict:
+    """属性名 -> 列名，如 User 的 _avatar -> avatar"""
+    return {attr.key: attr.columns[0].name for attr in inspect(cls).column_attrs}
+
+
+def _normalize_rows(cls, rows) -> list:
+    """将属性名转为列名，忽略不是列的键(与 create 一致)"""
+    names = _column_names(cls)
+    return [
+        {names[key]: value for key, value in row.items() if key in names}
+        for row in rows
+    ]
+
+
+def _chunks(rows, chunk_size):
+    """
+    按 chunk_size 切分，executemany 要求同一批次内各行的键相同，
+    键不同的相邻行分入不同批次，批次之间保持原有顺序
+    """
+    for _, group in groupby(rows, key=lambda row: tuple(sorted(row))):
+        group = iter(group)
+        while True:
+            chunk = list(islice(group, chunk_size))
+            if not chunk:
+                break
+            yield chunk
+
+
+def _create_many(cls, rows, chunk_size, return_pk):
+    """
+    以 core 层的 insert 批量写入，不经过会话的 identity map
+    return_pk 为 True 时返回新增行的主键列表，顺序与 rows 一致：
+    PostgreSQL 使用 RETURNING；SQLite 及 MySQL 的一条多行 insert 中自增主键连续，
+    由 lastrowid 及行数推算；MySQL 的 innodb_autoinc_lock_mode 为 2 时不保证连续，
+    与其他数据库一样逐行写入
+    """
+    table = cls.__table__
+    rows = _normalize_rows(cls, rows)
+    if not return_pk:
+        for chunk in _chunks(rows, chunk_size):
+            db.session.execute(table.insert(), chunk)
+        return None
+    pk = table.primary_key.columns.values()[0]
+    dialect = _dialect(cls)
+    step = _autoincrement_step(dialect)
+    pks = list()
+    for chunk in _chunks(rows, chunk_size):
+        if pk.name in chunk[0]:
+            # 主键已给出
+            db.session.execute(table.insert(), chunk)
+            pks.extend(row[pk.name] for row in chunk)
+        elif dialect == "postgresql":
+            # 多行 VALUES 配合 RETURNING，返回顺序与写入顺序一致
+            result = db.session.execute(table.insert().values(chunk).returning(pk))
+            pks.extend(row[0] for row in result)
+        elif step is not None:
+            result = db.session.execute(table.insert().values(chunk))
+            # SQLite 返回最后一行的主键，MySQL 返回第一行的主键
+            first = result.lastrowid
+            if dialect == "sqlite":
+                first -= len(chunk) - 1
+            pks.extend(first + i * step for i in range(len(chunk)))
+        else:
+            for row in chunk:
+                result = db.session.execute(table.insert(), row)
+                pks.append(result.inserted_primary_key[0])
+    return pks
+
+
+def _autoincrement_step(dialect):
+    """一条多行 insert 中自增主键的间隔，不保证连续时返回 None"""
+    if dialect == "sqlite":
+        return 1
+    if dialect == "mysql":
+        mode, step = db.session.execute(
+            text("SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment")
+        ).one()
+        return step if mode != 2 else None
+    return None
+
+
+def _update_many(cls, rows, chunk_size):
+    """以 core 层的 update 按主键批量更新"""
+    table = cls.__table__
+    pk = table.primary_key.columns.values()[0]
+    rows = _normalize_rows(cls, rows)
+    for chunk in _chunks(rows, chunk_size):
+        if pk.name not in chunk[0]:
+            raise ValueError("update_many 的每一行都需带有主键 {}".format(pk.name))
+        # 绑定参数名不能与列名相同
+        params = [{"_" + key: value for key, value in row.items()} for row in chunk]
+        statement = (
+            table.update()
+            .where(pk == bindparam("_" + pk.name))
+            .values({key: bindparam("_" + key) for key in chunk[0] if key != pk.name})
+        )
+        db.session.execute(statement, params)
+
+
+def _upsert_many(cls, rows, index_elements, chunk_size):
+    """
+    批量写入，与 index_elements(默认为主键)冲突的行改为更新
+    MySQL 以全部唯一索引判断冲突；其他数据库先查询已存在的行，再分别写入和更新
+    """
+    table = cls.__table__
+    index_elements = list(index_elements or [c.name for c in table.primary_key.columns])
+    rows = _normalize_rows(cls, rows)
+    dialect = _dialect(cls)
+    for chunk in _chunks(rows, chunk_size):
+        fields = [key for key in chunk[0] if key not in index_elements]
+        if dialect in ("sqlite", "postgresql"):
+            insert = (sqlite if dialect == "sqlite" else postgresql).insert(table)
+            if fields:
+                statement = insert.on_conflict_do_update(
+                    index_elements=index_elements,
+                    set_={key: insert.excluded[key] for key in fields},
+                )
+            else:
+                statement = insert.on_conflict_do_nothing(index_elements=index_elements)
+            db.session.execute(statement, chunk)
+        elif dialect == "mysql":
+            insert = mysql.insert(table)
+            if fields:
+                statement = insert.on_duplicate_key_update(
+                    {key: insert.inserted[key] for key in fields}
+                )
+            else:
+                statement = insert.prefix_with("IGNORE")
+            db.session.execute(statement, chunk)
+        else:
+            _upsert_chunk(cls, chunk, index_elements)
+
+
+def _dialect(cls) -> str:
+    return db.session().get_bind(cls.__mapper__).dialect.name
+
+
+def _upsert_chunk(cls, chunk, index_elements):
+    table = cls.__table__
+    columns = [table.c[name] for name in index_elements]
+    keys = [tuple(row[name] for name in index_elements) for row in chunk]
+    if len(columns) == 1:
+        condition = columns[0].in_([key[0] for key in keys])
+    else:
+        condition = tuple_(*columns).in_(keys)
+    existed = set(
+        tuple(row) for row in db.session.execute(select(*columns).where(condition))
+    )
+    new_rows = [row for row, key in zip(chunk, keys) if key not in existed]
+    if new_rows:
+        db.session.execute(table.insert(), new_rows)
+    fields = [key for key in chunk[0] if key not in index_elements]
+    old_rows = [row for row, key in zip(chunk, keys) if key in existed]
+    if old_rows and fields:
+        statement = (
+            table.update()
+            .where(and_(*(c == bindparam("_" + c.name) for c in columns)))
+            .values({key: bindparam("_" + key) for key in fields})
+        )
+        db.session.execute(
+            statement,
+            [{"_" + key: value for key, value in row.items()} for row in old_rows],
+        )
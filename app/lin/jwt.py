@@ -8,24 +8,70 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import hashlib
+import time
 from functools import wraps
 
-from flask import request
+from flask import current_app, request
 from flask_jwt_extended import (
     JWTManager,
     create_access_token,
     create_refresh_token,
     get_current_user,
+    get_jwt,
 )
 from flask_jwt_extended.view_decorators import jwt_required
 
+from .cache import LRUCache
 from .exception import NotFound, TokenExpired, TokenInvalid, UnAuthentication
 from .manager import manager
+from .revocation import revocation
 
-__all__ = ["login_required", "admin_required", "group_required"]
+__all__ = ["login_required", "admin_required", "group_required", "revoke_token"]
 
 SCOPE = "lin"
-jwt = JWTManager()
+
+
+class LinJWTManager(JWTManager):
+    """
+    缓存验证通过的令牌内容，同一令牌再次请求时跳过签名校验及解析
+    以原始令牌的摘要为键，条目在令牌过期时失效
+    """
+
+    def __init__(self, app=None):
+        self.token_cache = LRUCache(4096)
+        super().__init__(app)
+
+    def init_app(self, app):
+        super().init_app(app)
+        self.token_cache = LRUCache(
+            app.config.get("CACHE", dict()).get("TOKEN_SIZE", 4096)
+        )
+
+    def _decode_jwt_from_config(
+        self, encoded_token, csrf_value=None, allow_expired=False
+    ):
+        # 允许过期或需校验 csrf 时不使用缓存
+        if allow_expired or csrf_value is not None or self.token_cache.maxsize <= 0:
+            return super()._decode_jwt_from_config(
+                encoded_token, csrf_value, allow_expired
+            )
+        raw = encoded_token
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        key = hashlib.sha256(raw).digest()
+        claims = self.token_cache.get(key)
+        if claims is None:
+            claims = super()._decode_jwt_from_config(encoded_token)
+            if "exp" in claims:
+                ttl = claims["exp"] - time.time()
+                if ttl > 0:
+                    self.token_cache.set(key, claims, ttl)
+        # 返回副本，调用方修改不影响缓存
+        return dict(claims)
+
+
+jwt = LinJWTManager()
 identity = dict(uid=0, scope=SCOPE)
 
 
@@ -52,12 +98,17 @@ def group_required(fn):
 
         # not admin
         if not current_user.is_admin:
+            meta = manager.ep_meta.get(request.endpoint)
+            # 令牌中的权限位图仍然有效时，直接按位判断
+            if manager.permission_index.is_allowed_by_claims(get_jwt(), meta):
+                return fn(*args, **kwargs)
 
-            group_ids = manager.find_group_ids_by_user_id(current_user.id)
-            if group_ids is None:
+            # 通过进程内权限索引鉴权，索引失效时才会查询数据库
+            group_ids = manager.permission_index.find_group_ids_by_user_id(current_user.id)
+            if not group_ids:
                 raise UnAuthentication("您还不属于任何分组，请联系超级管理员获得权限")  # type: ignore
 
-            if not manager.is_user_allowed(group_ids):
+            if not manager.permission_index.is_allowed(group_ids, meta):
                 raise UnAuthentication("权限不够，请联系超级管理员获得权限")  # type: ignore
             else:
                 return fn(*args, **kwargs)
@@ -85,7 +136,7 @@ def user_loader_callback(t, identity):
         raise UnAuthentication()  # type: ignore
     # token is granted , user must be exit
     # 如果token已经被颁发，则该用户一定存在
-    user = manager.find_user(id=identity["uid"])
+    user = manager.load_user(identity["uid"])
     if user is None:
         raise NotFound("用户不存在")  # type: ignore
     return user
@@ -106,6 +157,17 @@ def unauthorized_loader_callback(e):
     return UnAuthentication("认证失败，请检查请求头或者重新登录")  # type: ignore
 
 
+@jwt.token_in_blocklist_loader
+def blocklist_loader_callback(jwt_header, jwt_payload):
+    # 布隆过滤器未命中时不查询数据库
+    return revocation.is_revoked(jwt_payload["jti"])
+
+
+@jwt.revoked_token_loader
+def revoked_loader_callback(jwt_header, jwt_payload):
+    return TokenInvalid(10043)  # type: ignore
+
+
 @jwt.additional_claims_loader
 def add_claims_to_access_token(identity):
     return {
@@ -148,10 +210,27 @@ def _check_is_active(current_user):
         raise UnAuthentication("您目前处于未激活状态，请联系超级管理员")
 
 
+def get_permission_claims(user_id) -> dict:
+    """
+    开启 JWT_PERMISSION_CLAIMS 时，将用户当前拥有的权限以位图形式写入 access token
+    """
+    if not current_app.config.get("JWT_PERMISSION_CLAIMS"):
+        return dict()
+    group_ids = manager.permission_index.find_group_ids_by_user_id(user_id)
+    return manager.permission_index.get_claims(group_ids)
+
+
 def get_tokens(user, verify_remote_addr=False):
     identity["uid"] = user.id
     if verify_remote_addr:
         identity["remote_addr"] = request.remote_addr
-    access_token = create_access_token(identity)
+    access_token = create_access_token(
+        identity, additional_claims=get_permission_claims(user.id)
+    )
     refresh_token = create_refresh_token(identity)
     return access_token, refresh_token
+
+
+def revoke_token(jwt_payload):
+    """注销令牌，需在 db.auto_commit() 中调用"""
+    revocation.revoke(jwt_payload["jti"], jwt_payload["exp"])
@@ -8,11 +8,21 @@ from flask import Blueprint, Flask
 from sqlalchemy.exc import DatabaseError
 
 from .apidoc import schema_response
+from .bus import bus
+from .count import counter
 from .db import db
 from .encoder import JSONEncoder, auto_response
 from .exception import APIException, HTTPException, InternalServerError
 from .jwt import jwt
+from .log_retention import log_retention
+from .log_search import log_search
+from .log_stats import log_stats
+from .log_writer import log_writer
 from .manager import Manager
+from .password import hasher
+from .profiler import profiler
+from .query_cache import query_cache
+from .revocation import revocation
 from .syslogger import SysLogger
 from .utils import permission_meta_infos
 
@@ -117,9 +127,20 @@ class Lin(object):
             permission_model=permission_model,
             group_permission_model=group_permission_model,
             user_group_model=user_group_model,
+            cache_config=app.config.get("CACHE", dict()),
         )
         self.app.extensions["manager"] = self.manager
         db.init_app(app)
+        bus.init_app(app)
+        hasher.init_app(app)
+        query_cache.init_app(app)
+        counter.init_app(app)
+        revocation.init_app(app)
+        profiler.init_app(app)
+        log_writer.init_app(app)
+        log_search.init_app(app)
+        log_retention.init_app(app)
+        log_stats.init_app(app)
         jwt.init_app(app)
         mount and self.mount(app)
         sync_permissions and self.sync_permissions(app)
@@ -129,9 +150,10 @@ class Lin(object):
     def sync_permissions(self, app):
         # 挂载后才能获取代码中的权限
         # 多进程/线程下可能同时写入相同数据，由权限表联合唯一约束限制
+        # 开启 SYNC_PERMISSIONS_LOCK 后由数据库行锁保证多进程依次同步
         try:
             with app.app_context():
-                self.manager.sync_permissions()
+                self.manager.sync_permissions(lock=app.config.get("SYNC_PERMISSIONS_LOCK", False))
         except DatabaseError:
             pass
 
@@ -0,0 +1,328 @@
+"""
+    log retention of Lin
+    ~~~~~~~~~
+
+    lin_log 按月分区及过期日志的归档
+
+    MySQL/PostgreSQL 上可将 lin_log 转换为按 create_time 的月份划分的原生分区表
+    (flask log partition)，带时间范围的查询只扫描相关的分区；
+    主键需包含分区列，转换后为 (id, create_time)，MySQL 的分区表不支持全文索引，
+    转换时会删除 ngram 全文索引，日志检索退回到 like(需重启服务)
+
+    过期的月份(flask log retain)先按月写入 lin_log-YYYY-MM.jsonl.gz，
+    已存在同名归档时依次写入 lin_log-YYYY-MM.1.jsonl.gz 等，不覆盖已有的归档；
+    只删除已归档的日志(id 不大于归档时的最大 id)，归档后写入的日志保留至下次归档，
+    分区表在该月没有归档后写入的日志时直接删除分区，否则(如 SQLite)按批次删除
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import gzip
+import os
+from datetime import datetime
+
+from sqlalchemy import func, select, text
+
+from .bus import bus
+from .db import db
+from .export import _write_jsonl
+from .logger import Log
+from .query_cache import CHANNEL_PREFIX
+
+__all__ = ["LogRetention", "log_retention", "month_range"]
+
+
+def month_range(start, end):
+    """start 至 end(不含) 之间每个月的第一天"""
+    month = datetime(start.year, start.month, 1)
+    while month < end:
+        yield month
+        month = _next_month(month)
+
+
+def _next_month(month):
+    if month.month == 12:
+        return datetime(month.year + 1, 1, 1)
+    return datetime(month.year, month.month + 1, 1)
+
+
+def _add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+class LogRetention(object):
+    def __init__(self, app=None):
+        # 保留最近 months 个月(含当月)的日志
+        self.months = 6
+        self.archive_dir = "archive"
+        self.months_ahead = 3
+        self.batch_size = 5000
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config.get("LOG_RETENTION", dict())
+        self.months = config.get("MONTHS", self.months)
+        self.archive_dir = config.get("ARCHIVE_DIR", self.archive_dir)
+        self.months_ahead = config.get("MONTHS_AHEAD", self.months_ahead)
+        self.batch_size = config.get("BATCH_SIZE", self.batch_size)
+        app.extensions["log_retention"] = self
+
+    @property
+    def dialect(self) -> str:
+        return db.engine.dialect.name
+
+    def expired_months(self, now=None) -> list:
+        """早于保留期限且存在日志的月份"""
+        now = now or datetime.now()
+        cutoff = _add_months(datetime(now.year, now.month, 1), 1 - self.months)
+        oldest = (
+            db.session.query(Log.create_time)
+            .filter(Log.create_time < cutoff)
+            .order_by(Log.create_time)
+            .primary()
+            .first()
+        )
+        if oldest is None:
+            return []
+        return list(month_range(oldest[0].replace(tzinfo=None), cutoff))
+
+    def retain(self, now=None) -> list:
+        """归档并删除过期的月份，返回 [(月份, 归档文件, 行数)]，没有日志的月份不归档"""
+        result = []
+        for month in self.expired_months(now):
+            path, count, last_id = self.archive(month)
+            self.purge(month, last_id)
+            if count:
+                result.append((month, path, count))
+        return result
+
+    def archive(self, month):
+        """
+        将该月的日志写入 jsonl.gz，返回 (文件路径, 行数, 归档的最大 id)
+        该月没有日志时不写入文件，返回 (None, 0, None)
+        """
+        table = Log.__table__
+        condition = _month_condition(table, month)
+        last_id = db.session.execute(select(func.max(table.c.id)).where(condition)).scalar()
+        if last_id is None:
+            return None, 0, None
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = self._archive_path(month)
+        statement = select(table).where(condition).where(table.c.id <= last_id).order_by(table.c.id)
+        count = 0
+        # 写入临时文件，完成后再替换，中途失败不会留下不完整的归档
+        with gzip.open(path + ".tmp", "wb") as f:
+            with db.query(statement, stream=True, yield_per=self.batch_size) as rows:
+                for chunk in _write_jsonl(rows, self.batch_size):
+                    count += chunk.count(b"\n")
+                    f.write(chunk)
+        os.replace(path + ".tmp", path)
+        return path, count, last_id
+
+    def _archive_path(self, month):
+        """该月尚未使用的归档文件名"""
+        name = "lin_log-{0:%Y-%m}".format(month)
+        path = os.path.join(self.archive_dir, name + ".jsonl.gz")
+        number = 0
+        while os.path.exists(path):
+            number += 1
+            path = os.path.join(self.archive_dir, "{0}.{1}.jsonl.gz".format(name, number))
+        return path
+
+    def purge(self, month, last_id=None):
+        """
+        删除该月 id 不大于 last_id 的日志，last_id 为空时该月没有已归档的日志
+        分区中没有其他日志时直接删除分区
+        """
+        table = Log.__table__
+        condition = _month_condition(table, month)
+        if last_id is not None:
+            newer = condition & (table.c.id > last_id)
+            condition = condition & (table.c.id <= last_id)
+        else:
+            newer = condition
+        if month in self.partitions() and not db.session.execute(select(table.c.id).where(newer).limit(1)).scalar():
+            self._drop_partition(month)
+        elif last_id is not None:
+            self._delete(condition)
+        else:
+            return
+        # DDL 及批量删除不经过查询缓存的写入记录，手动失效
+        with db.auto_commit():
+            bus.publish(CHANNEL_PREFIX + Log.__tablename__)
+
+    def _delete(self, condition):
+        table = Log.__table__
+        while True:
+            with db.auto_commit():
+                ids = [row[0] for row in db.session.execute(select(table.c.id).where(condition).limit(self.batch_size))]
+                if ids:
+                    db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            if len(ids) < self.batch_size:
+                return
+
+    # 原生分区
+
+    def partitions(self) -> dict:
+        """已建立的月份分区，月份 -> 分区名"""
+        if self.dialect == "mysql":
+            names = db.session.execute(
+                text(
+                    "SELECT partition_name FROM information_schema.PARTITIONS "
+                    "WHERE table_schema = DATABASE() AND table_name = 'lin_log' "
+                    "AND partition_name IS NOT NULL"
+                )
+            ).scalars()
+        elif self.dialect == "postgresql":
+            names = db.session.execute(
+                text(
+                    "SELECT c.relname FROM pg_inherits i "
+                    "JOIN pg_class c ON c.oid = i.inhrelid "
+                    "JOIN pg_class p ON p.oid = i.inhparent "
+                    "WHERE p.relname = 'lin_log'"
+                )
+            ).scalars()
+        else:
+            return dict()
+        return _parse_partitions(names)
+
+    def is_partitioned(self) -> bool:
+        if self.dialect == "mysql":
+            return bool(self.partitions())
+        if self.dialect == "postgresql":
+            return bool(
+                db.session.execute(
+                    text(
+                        "SELECT 1 FROM pg_partitioned_table t "
+                        "JOIN pg_class c ON c.oid = t.partrelid "
+                        "WHERE c.relname = 'lin_log'"
+                    )
+                ).scalar()
+            )
+        return False
+
+    def partition(self, now=None) -> list:
+        """
+        转换为按月分区的表(首次)，并建立至未来 months_ahead 个月的分区
+        返回新建分区的月份
+        """
+        if self.dialect not in ("mysql", "postgresql"):
+            raise RuntimeError("仅 MySQL 及 PostgreSQL 支持原生分区")
+        now = now or datetime.now()
+        last = _add_months(datetime(now.year, now.month, 1), self.months_ahead + 1)
+        if not self.is_partitioned():
+            oldest = db.session.query(func.min(Log.create_time)).scalar() or now
+            months = list(month_range(oldest.replace(tzinfo=None), last))
+            if self.dialect == "mysql":
+                self._convert_mysql(months)
+            else:
+                self._convert_postgresql(months)
+            return months
+        existing = self.partitions()
+        start = max(existing) if existing else datetime(now.year, now.month, 1)
+        months = [month for month in month_range(start, last) if month not in existing]
+        for month in months:
+            self._add_partition(month)
+        return months
+
+    def _convert_mysql(self, months):
+        statements = []
+        if db.session.execute(
+            text(
+                "SELECT 1 FROM information_schema.STATISTICS "
+                "WHERE table_schema = DATABASE() AND table_name = 'lin_log' "
+                "AND index_name = 'ft_lin_log_message'"
+            )
+        ).scalar():
+            statements.append("ALTER TABLE lin_log DROP INDEX ft_lin_log_message")
+        statements.append("ALTER TABLE lin_log DROP PRIMARY KEY, ADD PRIMARY KEY (id, create_time)")
+        definitions = [_mysql_partition(month) for month in months]
+        definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        statements.append(
+            "ALTER TABLE lin_log PARTITION BY RANGE (TO_DAYS(create_time)) ({0})".format(", ".join(definitions))
+        )
+        self._execute_ddl(statements)
+
+    def _convert_postgresql(self, months):
+        statements = [
+            "ALTER TABLE lin_log RENAME TO lin_log_legacy",
+            "CREATE TABLE lin_log (LIKE lin_log_legacy INCLUDING DEFAULTS) " "PARTITION BY RANGE (create_time)",
+            "ALTER TABLE lin_log ADD PRIMARY KEY (id, create_time)",
+        ]
+        statements.extend(_postgresql_partition(month) for month in months)
+        statements += [
+            # create_time 为空或超出已建分区的日志
+            "CREATE TABLE lin_log_default PARTITION OF lin_log DEFAULT",
+            "INSERT INTO lin_log SELECT * FROM lin_log_legacy",
+            "ALTER SEQUENCE lin_log_id_seq OWNED BY lin_log.id",
+            "DROP TABLE lin_log_legacy",
+            "CREATE INDEX create_time_id ON lin_log (create_time, id)",
+        ]
+        self._execute_ddl(statements)
+
+    def _add_partition(self, month):
+        if self.dialect == "mysql":
+            statements = [
+                "ALTER TABLE lin_log REORGANIZE PARTITION pmax INTO "
+                "({0}, PARTITION pmax VALUES LESS THAN MAXVALUE)".format(_mysql_partition(month))
+            ]
+        else:
+            # 默认分区中已有该月的日志时无法直接建立分区，
+            # 先分离默认分区，建立分区后将该月的日志移入，再重新附加
+            condition = "create_time >= '{0:%Y-%m-%d}' AND create_time < '{1:%Y-%m-%d}'".format(
+                month, _next_month(month)
+            )
+            statements = [
+                "ALTER TABLE lin_log DETACH PARTITION lin_log_default",
+                _postgresql_partition(month),
+                "INSERT INTO lin_log SELECT * FROM lin_log_default WHERE " + condition,
+                "DELETE FROM lin_log_default WHERE " + condition,
+                "ALTER TABLE lin_log ATTACH PARTITION lin_log_default DEFAULT",
+            ]
+        self._execute_ddl(statements)
+
+    def _drop_partition(self, month):
+        name = self.partitions()[month]
+        if self.dialect == "mysql":
+            statement = "ALTER TABLE lin_log DROP PARTITION {0}".format(name)
+        else:
+            statement = "DROP TABLE {0}".format(name)
+        self._execute_ddl([statement])
+
+    @staticmethod
+    def _execute_ddl(statements):
+        # 先结束会话的事务，释放其持有的表锁，否则 DDL 会一直等待
+        db.session.commit()
+        with db.engine.begin() as conn:
+            for statement in statements:
+                conn.exec_driver_sql(statement)
+
+
+def _month_condition(table, month):
+    return (table.c.create_time >= month) & (table.c.create_time < _next_month(month))
+
+
+def _parse_partitions(names) -> dict:
+    """由分区名(p202001 或 lin_log_p202001)得到 月份 -> 分区名，忽略其他分区"""
+    partitions = dict()
+    for name in names:
+        suffix = name.rsplit("p", 1)[-1]
+        if len(suffix) == 6 and suffix.isdigit():
+            partitions[datetime(int(suffix[:4]), int(suffix[4:]), 1)] = name
+    return partitions
+
+
+def _mysql_partition(month):
+    return "PARTITION p{0:%Y%m} VALUES LESS THAN (TO_DAYS('{1:%Y-%m-%d}'))".format(month, _next_month(month))
+
+
+def _postgresql_partition(month):
+    return (
+        "CREATE TABLE lin_log_p{0:%Y%m} PARTITION OF lin_log "
+        "FOR VALUES FROM ('{0:%Y-%m-%d}') TO ('{1:%Y-%m-%d}')".format(month, _next_month(month))
+    )
+
+
+log_retention = LogRetention()
@@ -0,0 +1,275 @@
+"""
+    log search of Lin
+    ~~~~~~~~~
+
+    日志信息(lin_log.message)的全文检索，按数据库选择后端：
+
+    fts5    SQLite 的 FTS5 外部内容表(trigram 分词)，由触发器与 lin_log 保持同步
+    mysql   MySQL 的 FULLTEXT 索引(ngram 分词，支持中文)
+    python  进程内的二元组倒排索引，只索引最近 window 条日志，检索前按最大 id 增量同步；
+            每个 worker 各持有一份，需显式指定
+    like    不使用索引，即 message like '%keyword%'
+
+    auto 时使用已建立的 FTS5 或 MySQL 全文索引，否则使用 like；
+    全文索引在 db.create_all 建表时或通过 flask db index 建立，不在请求中建立
+    关键字短于分词长度时无法使用索引，退回到 like；各后端的结果均与 like 一致
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import and_, event, exc, func, literal_column, or_, select, table, text
+
+from .db import db
+from .log_retention import log_retention
+from .logger import Log
+
+__all__ = ["LogSearch", "NgramIndex", "log_search"]
+
+BACKENDS = ("auto", "fts5", "mysql", "python", "like")
+
+FTS5_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS lin_log_fts USING fts5("
+    "message, content='lin_log', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS lin_log_fts_ai AFTER INSERT ON lin_log BEGIN "
+    "INSERT INTO lin_log_fts(rowid, message) VALUES (new.id, new.message); END",
+    "CREATE TRIGGER IF NOT EXISTS lin_log_fts_ad AFTER DELETE ON lin_log BEGIN "
+    "INSERT INTO lin_log_fts(lin_log_fts, rowid, message) "
+    "VALUES ('delete', old.id, old.message); END",
+    "CREATE TRIGGER IF NOT EXISTS lin_log_fts_au AFTER UPDATE OF message ON lin_log "
+    "BEGIN INSERT INTO lin_log_fts(lin_log_fts, rowid, message) "
+    "VALUES ('delete', old.id, old.message); "
+    "INSERT INTO lin_log_fts(rowid, message) VALUES (new.id, new.message); END",
+    "INSERT INTO lin_log_fts(lin_log_fts) VALUES ('rebuild')",
+)
+MYSQL_DDL = "ALTER TABLE lin_log ADD FULLTEXT INDEX ft_lin_log_message (message) " "WITH PARSER ngram"
+# 分词长度，关键字短于该长度时使用 like
+MIN_LENGTH = {"fts5": 3, "mysql": 2, "python": 2}
+# 单条语句中 IN 的参数个数上限，低于 SQLite 3.32 之前的 999
+BIND_LIMIT = 900
+
+
+class NgramIndex(object):
+    """
+    进程内的二元组倒排索引，只索引 id 最大的 window 条日志，内存占用与日志总量无关
+    更早的日志(id 不大于 floor)检索时使用 like
+
+    多个进程并发写入时，id 较小的日志可能晚于 id 较大的日志提交，
+    同步时最近 gap_window 个 id 中缺少的记为空缺，此后每次同步重新查找，
+    超过 gap_timeout 秒仍未出现的空缺视为已回滚；空缺及尚未同步的日志检索时交由 like 判断
+    """
+
+    def __init__(self, max_candidates=BIND_LIMIT, window=100000, gap_window=10000, gap_timeout=60):
+        # 候选超过该数量时索引的区分度不足，直接使用 like
+        self.max_candidates = max_candidates
+        self.window = window
+        self.gap_window = gap_window
+        self.gap_timeout = gap_timeout
+        self.last_id = 0
+        # id 不大于 floor 的日志不在索引中
+        self.floor = 0
+        # 上次清理时的 floor
+        self._evicted = 0
+        # 尚未出现的 id -> 发现空缺的时间
+        self._gaps = dict()
+        self._postings = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """索引 id 大于 last_id 的日志及此前空缺的日志，窗口之外的日志移出索引"""
+        with self._lock:
+            top = db.session.query(func.max(Log.id)).primary().scalar() or 0
+            now = time.monotonic()
+            floor = max(self.floor, top - self.window)
+            self._gaps = {id: seen for id, seen in self._gaps.items() if id > floor and now - seen < self.gap_timeout}
+            if top <= self.last_id and not self._gaps:
+                return
+            start = max(self.last_id, floor)
+            found = set(self._index(Log.id > start, Log.id <= top))
+            late = sorted(self._gaps)
+            for i in range(0, len(late), BIND_LIMIT):
+                for id in self._index(Log.id.in_(late[i : i + BIND_LIMIT])):
+                    del self._gaps[id]
+            # 晚提交的日志只出现在最近分配的 id 中
+            for id in range(max(start, top - self.gap_window) + 1, top + 1):
+                if id not in found:
+                    self._gaps[id] = now
+            self.last_id = max(self.last_id, top)
+            self.floor = floor
+            # 窗口移动超过四分之一时再清理，避免每次同步都遍历全部倒排表
+            if floor - self._evicted >= self.window // 4:
+                self._evict(floor)
+
+    def _index(self, *conditions) -> list:
+        """索引满足条件的日志，返回其 id"""
+        rows = db.session.query(Log.id, Log.message).filter(*conditions).order_by(Log.id).primary().yield_per(1000)
+        ids = []
+        for id, message in rows:
+            for gram in _grams(message or ""):
+                self._postings[gram].add(id)
+            ids.append(id)
+        return ids
+
+    def _evict(self, floor):
+        postings = defaultdict(set)
+        for gram, ids in self._postings.items():
+            ids = {id for id in ids if id > floor}
+            if ids:
+                postings[gram] = ids
+        self._postings = postings
+        self._evicted = floor
+
+    def candidates(self, keyword):
+        """索引窗口内可能包含 keyword 的日志 id，含尚未出现的空缺，无法使用索引时返回 None"""
+        with self._lock:
+            return self._candidates(keyword)
+
+    def _candidates(self, keyword):
+        grams = _grams(keyword)
+        if not grams:
+            return None
+        postings = [self._postings.get(gram, set()) for gram in grams]
+        postings.sort(key=len)
+        ids = {id for id in postings[0] if id > self.floor}
+        for posting in postings[1:]:
+            ids &= posting
+        ids.update(self._gaps)
+        # 候选过多时区分度不足，且 IN 的参数个数受数据库限制
+        if len(ids) > min(self.max_candidates, BIND_LIMIT):
+            return None
+        return ids
+
+    def condition(self, keyword):
+        """
+        限定可能包含 keyword 的日志的条件，与 like 一同使用；无法使用索引时返回 None
+        窗口之外及同步之后写入的日志不在索引中，由 like 判断
+        """
+        with self._lock:
+            ids = self._candidates(keyword)
+            if ids is None:
+                return None
+            return or_(Log.id.in_(sorted(ids)), Log.id <= self.floor, Log.id > self.last_id)
+
+
+class LogSearch(object):
+    def __init__(self, app=None):
+        self.backend = "auto"
+        self.index = NgramIndex()
+        # 实际使用的后端，首次检索时确定
+        self._resolved = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config.get("LOG_SEARCH", dict())
+        self.backend = config.get("BACKEND", self.backend)
+        if self.backend not in BACKENDS:
+            raise ValueError("unknown log search backend: {0}".format(self.backend))
+        self.index.max_candidates = config.get("MAX_CANDIDATES", self.index.max_candidates)
+        self.index.window = config.get("PYTHON_WINDOW", self.index.window)
+        self._resolved = None
+        app.extensions["log_search"] = self
+
+    def search(self, query, keyword):
+        """
+        筛选 message 包含 keyword 的日志，返回 (query, score)
+        score 为相关度表达式，越大越相关；后端不支持排序时为 None
+        """
+        backend = self.resolve()
+        like = Log.message.like(f"%{keyword}%")
+        if len(keyword) < MIN_LENGTH.get(backend, 0):
+            return query.filter(like), None
+        if backend == "fts5":
+            phrase = '"{0}"'.format(keyword.replace('"', '""'))
+            fts = table("lin_log_fts")
+            matched = (
+                select(
+                    literal_column("lin_log_fts.rowid").label("id"),
+                    (-func.bm25(literal_column("lin_log_fts"))).label("score"),
+                )
+                .select_from(fts)
+                .where(text("lin_log_fts MATCH :lin_keyword").bindparams(lin_keyword=phrase))
+                .subquery()
+            )
+            query = query.join(matched, matched.c.id == Log.id)
+            return query, matched.c.score
+        if backend == "mysql":
+            score = text("MATCH (lin_log.message) AGAINST (:lin_keyword IN BOOLEAN MODE)")
+            score = score.bindparams(lin_keyword='"{0}"'.format(keyword.replace('"', "")))
+            # ngram 的短语匹配近似于子串匹配，再以 like 精确筛选
+            return query.filter(score, like), score
+        if backend == "python":
+            self.index.sync()
+            condition = self.index.condition(keyword)
+            if condition is not None:
+                return query.filter(and_(condition, like)), None
+        return query.filter(like), None
+
+    def resolve(self) -> str:
+        if self._resolved is not None:
+            return self._resolved
+        with self._lock:
+            if self._resolved is None:
+                self._resolved = self._detect()
+        return self._resolved
+
+    def _detect(self) -> str:
+        """
+        指定的或 auto 时适用的全文索引尚未建立(或数据库不支持)时使用 like
+        建立索引需重建整张表的索引，不在请求中进行
+        """
+        if self.backend in ("python", "like"):
+            return self.backend
+        dialect = db.engine.dialect.name
+        if self.backend == "fts5" or (self.backend == "auto" and dialect == "sqlite"):
+            with db.engine.connect() as conn:
+                exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'lin_log_fts'").scalar()
+            return "fts5" if exists else "like"
+        if self.backend == "mysql" or (self.backend == "auto" and dialect == "mysql"):
+            with db.engine.connect() as conn:
+                exists = conn.exec_driver_sql(
+                    "SELECT 1 FROM information_schema.STATISTICS "
+                    "WHERE table_schema = DATABASE() AND table_name = 'lin_log' "
+                    "AND index_type = 'FULLTEXT' LIMIT 1"
+                ).scalar()
+            return "mysql" if exists else "like"
+        return "like"
+
+    def create_index(self):
+        """为已存在的 lin_log 表建立全文索引，MySQL 的分区表不支持全文索引"""
+        if db.engine.dialect.name == "mysql" and log_retention.is_partitioned():
+            raise RuntimeError("lin_log 为 MySQL 分区表，不支持全文索引，日志检索使用 like")
+        with db.engine.begin() as conn:
+            _create_index(Log.__table__, conn)
+        self._resolved = None
+
+
+def _grams(value) -> set:
+    value = value.lower()
+    return {value[i : i + 2] for i in range(len(value) - 1)}
+
+
+def _create_fts5(conn):
+    for ddl in FTS5_DDL:
+        conn.exec_driver_sql(ddl)
+
+
+@event.listens_for(Log.__table__, "after_create")
+def _create_index(target, connection, **kwargs):
+    """db.create_all 建表后建立全文索引"""
+    dialect = connection.dialect.name
+    try:
+        if dialect == "sqlite":
+            _create_fts5(connection)
+        elif dialect == "mysql":
+            connection.exec_driver_sql(MYSQL_DDL)
+    except exc.DBAPIError:
+        # 数据库不支持时检索退回到其他后端
+        pass
+
+
+log_search = LogSearch()
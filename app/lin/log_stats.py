@@ -0,0 +1,176 @@
+"""
+    log stats of Lin
+    ~~~~~~~~~
+
+    行为日志的按日汇总，供统计面板使用
+
+    lin_log_stat 中每行为某一天某个维度下某个值的日志条数，维度为：
+
+    day         当天的日志总数，值为空字符串
+    user        按用户名
+    permission  按权限
+    path        按请求路径
+
+    日志由 log_writer 批量写入时在同一事务中累加对应的行，同一批次先在进程内合并，
+    统计查询只读取汇总表，代价与日志总量无关；
+    汇总计入全部日志(含软删除的日志)，不随日志的删除而减少，
+    可通过 flask log rebuild 按日志重建
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import Column, Date, Integer, String, and_, bindparam, func, literal, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from .db import db
+from .interface import BaseCrud
+from .logger import Log
+
+__all__ = ["LogStat", "LogStats", "log_stats", "DIMENSIONS"]
+
+# 维度 -> lin_log 中对应的列名
+DIMENSIONS = {
+    "day": None,
+    "user": "username",
+    "permission": "permission",
+    "path": "path",
+}
+
+
+class LogStat(BaseCrud):
+    __tablename__ = "lin_log_stat"
+
+    day = Column(Date(), primary_key=True, comment="日期")
+    dimension = Column(String(20), primary_key=True, comment="统计维度")
+    key = Column(String(100), primary_key=True, comment="维度的值")
+    count = Column(Integer(), nullable=False, default=0, comment="日志条数")
+
+
+class LogStats(object):
+    def __init__(self, app=None):
+        self.enabled = True
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get("LOG_STATS", dict()).get("ENABLE", True)
+        app.extensions["log_stats"] = self
+
+    def add(self, rows):
+        """
+        在当前会话的事务中累加日志的汇总，rows 为 lin_log 各列的字典
+        与日志一同提交
+        """
+        if not self.enabled:
+            return
+        counter = Counter()
+        for row in rows:
+            day = (row.get("create_time") or datetime.now()).date()
+            for dimension, column in DIMENSIONS.items():
+                key = "" if column is None else (row.get(column) or "")
+                counter[day, dimension, str(key)[:100]] += 1
+        if counter:
+            _increment(
+                [
+                    dict(day=day, dimension=dimension, key=key, count=count)
+                    for (day, dimension, key), count in sorted(counter.items())
+                ]
+            )
+
+    def query(self, dimension, start=None, end=None, count=None) -> list:
+        """
+        start 至 end(含) 之间的汇总，返回 [(值, 条数)]
+        day 维度按日期升序，值为日期；其他维度按条数降序取前 count 个
+        """
+        table = LogStat.__table__
+        conditions = [table.c.dimension == dimension]
+        if start is not None:
+            conditions.append(table.c.day >= start)
+        if end is not None:
+            conditions.append(table.c.day <= end)
+        total = func.sum(table.c.count).label("count")
+        if dimension == "day":
+            statement = select(table.c.day, total).where(*conditions).group_by(table.c.day).order_by(table.c.day)
+        else:
+            statement = (
+                select(table.c.key, total)
+                .where(*conditions)
+                .group_by(table.c.key)
+                .order_by(total.desc(), table.c.key)
+                .limit(count)
+            )
+        return [tuple(row) for row in db.session.execute(statement)]
+
+    def rebuild(self, start=None, end=None) -> int:
+        """
+        按 lin_log 重建 start 至 end(含) 之间的汇总，返回重建的行数
+        start 默认为最早的日志所在的日期，更早的汇总(日志已删除)保留
+        与累加一致，软删除的日志同样计入
+        重建期间写入的日志可能重复计入，应在写入较少时执行
+        """
+        table = LogStat.__table__
+        log = Log.__table__
+        day = func.date(log.c.create_time, type_=Date())
+        if start is None:
+            oldest = db.session.execute(select(func.min(day))).scalar()
+            if oldest is None:
+                return 0
+            start = oldest
+        conditions = [day >= start]
+        delete = table.delete().where(table.c.day >= start)
+        if end is not None:
+            conditions.append(day <= end)
+            delete = delete.where(table.c.day <= end)
+        with db.auto_commit():
+            db.session.execute(delete)
+            for dimension, column in DIMENSIONS.items():
+                key = literal("") if column is None else func.coalesce(log.c[column], "")
+                source = select(day, literal(dimension), key, func.count()).where(*conditions).group_by(day, key)
+                db.session.execute(table.insert().from_select(["day", "dimension", "key", "count"], source))
+        return db.session.execute(select(func.count()).select_from(table).where(table.c.day >= start)).scalar()
+
+
+def _increment(rows):
+    """按主键累加 count，不存在的行写入"""
+    table = LogStat.__table__
+    dialect = db.session().get_bind(LogStat.__mapper__).dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = (sqlite if dialect == "sqlite" else postgresql).insert(table)
+        statement = insert.on_conflict_do_update(
+            index_elements=["day", "dimension", "key"],
+            set_=dict(count=table.c.count + insert.excluded["count"]),
+        )
+        db.session.execute(statement, rows)
+    elif dialect == "mysql":
+        insert = mysql.insert(table)
+        statement = insert.on_duplicate_key_update(count=table.c.count + insert.inserted["count"])
+        db.session.execute(statement, rows)
+    else:
+        statement = (
+            table.update()
+            .where(
+                and_(
+                    table.c.day == bindparam("_day"),
+                    table.c.dimension == bindparam("_dimension"),
+                    table.c.key == bindparam("_key"),
+                )
+            )
+            .values(count=table.c.count + bindparam("_count"))
+        )
+        for row in rows:
+            params = {"_" + key: value for key, value in row.items()}
+            if db.session.execute(statement, params).rowcount > 0:
+                continue
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(table.insert(), row)
+            except IntegrityError:
+                # 其他进程已写入该行
+                db.session.execute(statement, params)
+
+
+log_stats = LogStats()
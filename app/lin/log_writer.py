@@ -0,0 +1,158 @@
+"""
+    log writer of Lin
+    ~~~~~~~~~
+
+    行为日志的异步批量写入
+
+    请求中只将日志放入进程内的队列，后台线程(gevent 下为 greenlet)攒够 batch_size 条
+    或每隔 interval 秒批量写入一次，日志的汇总(log_stats)在同一批次中合并累加，
+    汇总表中当天的行每批只更新一次，不随每个请求更新；
+    队列已满时请求至多等待 block_timeout 秒，仍无空位时退回到在请求中同步写入；
+    进程退出时写入队列中剩余的日志
+
+    sync 模式下日志随请求同步写入并提交，用于测试
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+from queue import Empty, Full, Queue
+
+from .db import db
+from .log_stats import log_stats
+from .logger import Log
+
+__all__ = ["LogWriter", "log_writer"]
+
+# 通知后台线程退出
+_STOP = object()
+
+
+class LogWriter(object):
+    def __init__(self, app=None):
+        self.sync = False
+        self.batch_size = 100
+        self.interval = 1
+        self.queue_size = 10000
+        self.block_timeout = 0.1
+        self._app = None
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config.get("LOG_WRITER", dict())
+        self.sync = config.get("SYNC", self.sync)
+        self.batch_size = config.get("BATCH_SIZE", self.batch_size)
+        self.interval = config.get("INTERVAL", self.interval)
+        self.queue_size = config.get("QUEUE_SIZE", self.queue_size)
+        self.block_timeout = config.get("BLOCK_TIMEOUT", self.block_timeout)
+        self._app = app
+        app.extensions["log_writer"] = self
+
+    def write(self, **kwargs):
+        """
+        写入一条行为日志，参数为 lin_log 的列
+        create_time 在此时确定，不受写入延迟的影响
+        """
+        kwargs.setdefault("create_time", datetime.now())
+        if self.sync:
+            self._write_now(kwargs)
+            return
+        try:
+            self._get_queue().put(kwargs, timeout=self.block_timeout)
+        except Full:
+            # 写入跟不上，退回到同步写入，由请求承担延迟
+            self._write_now(kwargs)
+
+    def flush(self):
+        """等待队列中的日志全部写入"""
+        if self._alive():
+            self._queue.join()
+        else:
+            self._drain()
+
+    def close(self, timeout=5):
+        """停止后台线程并写入剩余的日志，进程退出时调用"""
+        if self._alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+        self._drain()
+
+    @staticmethod
+    def _write_now(row):
+        Log.create_log(**row)
+        log_stats.add([row])
+        db.session.commit()
+
+    def _get_queue(self) -> Queue:
+        # 后台线程需在 worker 进程 fork 之后启动
+        if self._pid == os.getpid():
+            return self._queue
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = Queue(self.queue_size)
+                self._thread = threading.Thread(target=self._run, name="lin-log-writer", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+                atexit.register(self.close)
+        return self._queue
+
+    def _alive(self) -> bool:
+        return self._pid == os.getpid() and self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while rows[-1] is not _STOP and len(rows) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+            stop = rows[-1] is _STOP
+            self._insert([row for row in rows if row is not _STOP])
+            for _ in rows:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _drain(self):
+        if self._queue is None:
+            return
+        rows = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except Empty:
+                break
+            if row is not _STOP:
+                rows.append(row)
+            self._queue.task_done()
+        for i in range(0, len(rows), self.batch_size):
+            self._insert(rows[i : i + self.batch_size])
+
+    def _insert(self, rows):
+        if not rows:
+            return
+        with self._app.app_context():
+            try:
+                Log.create_many(rows, chunk_size=self.batch_size)
+                log_stats.add(rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self._app.logger.exception("failed to write %d logs", len(rows))
+
+
+log_writer = LogWriter()
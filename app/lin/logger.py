@@ -10,9 +10,9 @@
 import re
 from functools import wraps
 
-from flask import Response, request
+from flask import Response, current_app, request
 from flask_jwt_extended import get_current_user
-from sqlalchemy import Column, Integer, String, func
+from sqlalchemy import Column, Index, Integer, String, func
 
 from .db import db
 from .interface import InfoCrud
@@ -21,6 +21,8 @@ from .manager import manager
 
 class Log(InfoCrud):
     __tablename__ = "lin_log"
+    # 游标分页按 (create_time, id) 定位
+    __table_args__ = (Index("create_time_id", "create_time", "id"),)
 
     id = Column(Integer(), primary_key=True)
     message = Column(String(450), comment="日志信息")
@@ -81,6 +83,7 @@ class Log(InfoCrud):
             .filter(cls.is_deleted == False)
             .group_by(cls.username)
             .having(func.count(cls.username) > 0)
+            .cached()
         )
         # [(‘张三',),('李四',),...] -> ['张三','李四',...]
         usernames = [x[0] for x in result.all()]
@@ -141,7 +144,8 @@ class Logger(object):
             status_code = getattr(self.response, "code", None)
         if status_code is None:
             status_code = 0
-        Log.create_log(
+        # 由后台线程批量写入，不增加请求的延迟
+        current_app.extensions["log_writer"].write(
             message=self.message,
             user_id=self.user.id,
             username=self.user.username,
@@ -149,7 +153,6 @@ class Logger(object):
             method=request.method,
             path=request.path,
             permission=permission,
-            commit=True,
         )
 
     # 解析自定义模板
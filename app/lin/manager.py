@@ -10,6 +10,9 @@
 
 
 from flask import current_app
+from sqlalchemy import inspect, select
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.local import LocalProxy
 
 from .db import db
@@ -32,6 +35,7 @@ class Manager(object):
         permission_model,
         group_permission_model,
         user_group_model,
+        cache_config=None,
     ):
         self.group_model = group_model
         self.user_model = user_model
@@ -39,12 +43,48 @@ class Manager(object):
         self.group_permission_model = group_permission_model
         self.user_group_model = user_group_model
         self.identity_model = identity_model
+        from .bus import bus
+        from .cache import LRUCache
         from .loader import Loader
+        from .permission import PermissionIndex
 
+        cache_config = cache_config or dict()
         self.loader: Loader = Loader(plugin_path)
+        # 进程内权限索引，group_required 鉴权时使用
+        self.permission_index = PermissionIndex(self)
+        bus.subscribe("permission", self.permission_index.invalidate)
+        # 用户快照缓存，uid -> 脱离会话的用户实例
+        self.user_cache = LRUCache(
+            cache_config.get("USER_SIZE", 1024), cache_config.get("USER_TTL", 300)
+        )
+        bus.subscribe("user", self.user_cache.clear)
 
     def find_user(self, **kwargs):
-        return self.user_model.query.filter_by(**kwargs).first()
+        return self.user_model.get_with_details(**kwargs)
+
+    def load_user(self, uid):
+        """
+        通过缓存获取用户，缓存中保存的是只读的用户快照
+        返回的实例由快照合并到当前会话中得到，不会查询数据库，可正常修改和提交
+        """
+        snapshot = self.user_cache.get(uid)
+        if snapshot is None:
+            user = self.find_user(id=uid)
+            if user is None:
+                return None
+            snapshot = _snapshot(user)
+            self.user_cache.set(uid, snapshot)
+        return db.session.merge(snapshot, load=False)
+
+    def evict_user(self, uid):
+        """
+        用户信息变动后，使所有进程的用户缓存失效
+        需在写操作所在的事务中调用，随事务一同提交
+        """
+        from .bus import bus
+
+        self.user_cache.pop(uid)
+        bus.publish("user")
 
     def verify_user(self, username, password):
         return self.user_model.verify(username, password)
@@ -111,6 +151,15 @@ class Manager(object):
         permission = result.first()
         return True if permission else False
 
+    def invalidate_permissions(self):
+        """
+        分组、权限或用户分组关系变动后，使所有进程的权限索引失效
+        需在写操作所在的事务中调用，随事务一同提交
+        """
+        from .bus import bus
+
+        bus.publish("permission")
+
     def find_permission_module(self, name):
         """通过权限寻找meta信息"""
         for _, meta in self.ep_meta.items():
@@ -137,69 +186,91 @@ class Manager(object):
         for plugin in self.plugins.values():
             return plugin.services.get(name)
 
-    def sync_permissions(self):
+    def sync_permissions(self, lock=False):
+        """
+        以 (module, name) 为键比对代码与权限表中的权限，批量写入差异
+        lock 为 True 时，在事务内锁定 lin_generation 中的同步行，多进程依次同步，
+        先获得锁的进程完成同步后，其余进程比对结果为空，不再写入
+        """
+        from .bus import bus
+
         with db.auto_commit():
             db.create_all()
-            permissions = self.permission_model.get(one=False)
-            # 新增的权限记录
-            new_added_permissions: set = set()
-            deleted_ids = [permission.id for permission in permissions]
-            # mount-> unmount
-            unmounted_ids = list()
-            # unmount-> mount 的记录
-            mounted_ids = list()
-            # 用代码中记录的权限比对数据库中的权限
+            if lock:
+                bus.lock("permission_sync")
+            table = self.permission_model.__table__
+            # 数据库中的权限 (module, name) -> (id, mount)
+            existed = {
+                (module, name): (id, mount)
+                for id, name, module, mount in db.session.execute(
+                    select(
+                        table.c.id, table.c.name, table.c.module, table.c.mount
+                    ).where(table.c.is_deleted == False)
+                )
+            }
+            # 代码中的权限 (module, name) -> mount
+            # 如果出现了复用同名权限，则要保证mount=True的权限生效
+            declared = dict()
             for _, meta in self.ep_meta.items():
                 name, module, mount = meta
-                # db_existed 判定 代码中的权限是否存在于权限表记录中
-                db_existed = False
-                for permission in permissions:
-                    if permission.name == name and permission.module == module:
-                        # 此条记录存在,从待删除列表中移除,不会被删除
-                        if permission.id in deleted_ids:
-                            deleted_ids.remove(permission.id)
-                        # 此条记录存在，不需要添加到权限表
-                        db_existed = True
-                        # 判定mount的变动情况，将记录id添加到对应的列表中
-                        if permission.mount != mount:
-                            if mount:
-                                mounted_ids.append(permission.id)
-                            else:
-                                unmounted_ids.append(permission.id)
-                        break
-                # 遍历结束，代码中的记录不存在于已有的权限表中，则将其添加到新增权限记录列表
-                if not db_existed:
-                    permission = self.permission_model()
-                    permission.name = name
-                    permission.module = module
-                    permission.mount = mount
-                    new_added_permissions.add(permission)
-            _sync_permissions(
-                self, new_added_permissions, unmounted_ids, mounted_ids, deleted_ids
-            )
+                declared[(module, name)] = declared.get((module, name), False) or mount
+
+            new_added_permissions = [
+                dict(module=module, name=name, mount=mount)
+                for (module, name), mount in declared.items()
+                if (module, name) not in existed
+            ]
+            # unmount-> mount 的记录
+            mounted_ids = list()
+            # mount-> unmount 的记录
+            unmounted_ids = list()
+            deleted_ids = list()
+            for key, (id, mount) in existed.items():
+                if key not in declared:
+                    deleted_ids.append(id)
+                elif declared[key] != mount:
+                    (mounted_ids if declared[key] else unmounted_ids).append(id)
+
+            if new_added_permissions or mounted_ids or unmounted_ids or deleted_ids:
+                _sync_permissions(
+                    self, new_added_permissions, unmounted_ids, mounted_ids, deleted_ids
+                )
+                self.invalidate_permissions()
 
 
 def _sync_permissions(
     manager, new_added_permissions, unmounted_ids, mounted_ids, deleted_ids
 ):
+    table = manager.permission_model.__table__
     if new_added_permissions:
-        db.session.add_all(new_added_permissions)
+        db.session.execute(table.insert(), new_added_permissions)
     if unmounted_ids:
-        manager.permission_model.query.filter(
-            manager.permission_model.id.in_(unmounted_ids)
-        ).update({"mount": False}, synchronize_session=False)
+        db.session.execute(
+            table.update().where(table.c.id.in_(unmounted_ids)).values(mount=False)
+        )
     if mounted_ids:
-        manager.permission_model.query.filter(
-            manager.permission_model.id.in_(mounted_ids)
-        ).update({"mount": True}, synchronize_session=False)
+        db.session.execute(
+            table.update().where(table.c.id.in_(mounted_ids)).values(mount=True)
+        )
     if deleted_ids:
-        manager.permission_model.query.filter(
-            manager.permission_model.id.in_(deleted_ids)
-        ).delete(synchronize_session=False)
+        db.session.execute(table.delete().where(table.c.id.in_(deleted_ids)))
         # 分组-权限关联表中的数据也要清理
-        manager.group_permission_model.query.filter(
-            manager.group_permission_model.permission_id.in_(deleted_ids)
-        ).delete(synchronize_session=False)
+        group_permission_table = manager.group_permission_model.__table__
+        db.session.execute(
+            group_permission_table.delete().where(
+                group_permission_table.c.permission_id.in_(deleted_ids)
+            )
+        )
+
+
+def _snapshot(instance):
+    """复制实例的列属性，得到一个不属于任何会话的 detached 实例"""
+    mapper = inspect(instance).mapper
+    snapshot = mapper.class_manager.new_instance()
+    for attr in mapper.column_attrs:
+        set_committed_value(snapshot, attr.key, getattr(instance, attr.key))
+    make_transient_to_detached(snapshot)
+    return snapshot
 
 
 def get_manager():
@@ -1,10 +1,8 @@
 import os
 
 from flask import current_app
-from sqlalchemy import func
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import exists, func
 
-from . import manager
 from .db import db
 from .enums import GroupLevelEnum
 from .exception import NotFound, ParameterError, UnAuthentication
@@ -16,6 +14,8 @@ from .interface import (
     UserIdentityInterface,
     UserInterface,
 )
+from .manager import manager
+from .password import hasher
 
 
 class Group(GroupInterface):
@@ -83,10 +83,10 @@ class User(UserInterface):
 
     @property
     def is_admin(self):
-        return (
-            manager.user_group_model.get(user_id=self.id).group_id
-            == GroupLevelEnum.ROOT.value
-        )
+        # 实例随请求的会话一同销毁，缓存在实例上即为请求内缓存
+        if getattr(self, "_is_admin", None) is None:
+            self._is_admin = db.session.query(_is_admin_clause(self.id)).scalar()
+        return self._is_admin
 
     @property
     def is_active(self):
@@ -94,37 +94,77 @@ class User(UserInterface):
 
     @property
     def password(self):
-        return manager.identity_model.get(user_id=self.id).credential
+        if getattr(self, "_credential", None) is None:
+            self._credential = manager.identity_model.get(user_id=self.id).credential
+        return self._credential
 
     @password.setter
     def password(self, raw):
         user_identity = manager.identity_model.get(user_id=self.id)
         if user_identity:
-            user_identity.credential = generate_password_hash(raw)
+            user_identity.credential = hasher.generate(raw)
             user_identity.update(synchronize_session=False)
         else:
             user_identity = manager.identity_model()
             user_identity.user_id = self.id
             user_identity.identity_type = "USERNAME_PASSWORD"
             user_identity.identity = "root"
-            user_identity.credential = generate_password_hash(raw)
+            user_identity.credential = hasher.generate(raw)
             db.session.add(user_identity)
+        self._credential = user_identity.credential
 
     def check_password(self, raw):
-        return check_password_hash(self.password, raw)
+        return hasher.check(self.password, raw)
+
+    @classmethod
+    def get_with_details(cls, **kwargs):
+        """
+        查询用户，并通过关联子查询一并取出是否为超级管理员及密码凭证
+        之后读取 is_admin、password 不再查询数据库
+        """
+        credential = (
+            db.session.query(manager.identity_model.credential)
+            .filter(
+                manager.identity_model.user_id == cls.id,
+                manager.identity_model.is_deleted == False,
+            )
+            .limit(1)
+            .scalar_subquery()
+        )
+        row = (
+            db.session.query(cls, credential, _is_admin_clause(cls.id))
+            .filter_by(**kwargs)
+            .first()
+        )
+        if row is None:
+            return None
+        user, user._credential, user._is_admin = row
+        return user
 
     @classmethod
     def verify(cls, username, password):
-        user = cls.query.filter_by(username=username).first()
+        user = cls.get_with_details(username=username)
         if user is None or user.is_deleted:
             raise NotFound("用户不存在")
         if not user.check_password(password):
             raise ParameterError("密码错误，请输入正确密码")
         if not user.is_active:
             raise UnAuthentication("您目前处于未激活状态，请联系超级管理员")
+        # 哈希参数已调整，登录成功后以新参数重新计算
+        if hasher.needs_rehash(user.password):
+            with db.auto_commit():
+                user.password = password
         return user
 
 
+def _is_admin_clause(user_id):
+    """用户是否属于超级管理员分组的 exists 子句"""
+    return exists().where(
+        manager.user_group_model.user_id == user_id,
+        manager.user_group_model.group_id == GroupLevelEnum.ROOT.value,
+    )
+
+
 class UserGroup(UserGroupInterface):
     pass
 
@@ -0,0 +1,54 @@
+"""
+    password hasher of Lin
+    ~~~~~~~~~
+
+    密码哈希的计算放到独立的线程池中执行，不阻塞 gevent 的事件循环
+    哈希算法及迭代次数可配置，旧参数生成的哈希可在登录成功后自动升级
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+from werkzeug.security import check_password_hash as _check_password_hash
+from werkzeug.security import generate_password_hash as _generate_password_hash
+
+from .threadpool import ThreadPool
+
+__all__ = ["PasswordHasher", "hasher"]
+
+
+class PasswordHasher(object):
+    def __init__(self, app=None):
+        self.method = "pbkdf2:sha256:%d" % DEFAULT_PBKDF2_ITERATIONS
+        self.salt_length = 16
+        self._pool = ThreadPool(4, "lin-hasher")
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.get("PASSWORD_HASH_METHOD", self.method)
+        self.salt_length = app.config.get("PASSWORD_HASH_SALT_LENGTH", self.salt_length)
+        self._pool.workers = app.config.get("PASSWORD_HASH_WORKERS", self._pool.workers)
+        app.extensions["hasher"] = self
+
+    def generate(self, raw) -> str:
+        return self._pool.run(_generate_password_hash, raw, self.method, self.salt_length)
+
+    def check(self, pwhash, raw) -> bool:
+        return self._pool.run(_check_password_hash, pwhash, raw)
+
+    def needs_rehash(self, pwhash) -> bool:
+        """哈希的算法、迭代次数或盐长度与当前配置不一致时需要重新计算"""
+        if pwhash.count("$") < 2:
+            return True
+        method, salt, _ = pwhash.split("$", 2)
+        return _normalize(method) != _normalize(self.method) or len(salt) != self.salt_length
+
+
+def _normalize(method) -> str:
+    if method.startswith("pbkdf2:") and method.count(":") == 1:
+        return "%s:%d" % (method, DEFAULT_PBKDF2_ITERATIONS)
+    return method
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,142 @@
+"""
+    permission index of Lin
+    ~~~~~~~~~
+
+    进程内的权限索引，鉴权时以字典查找代替数据库查询
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import hashlib
+import threading
+from typing import Dict, Set, Tuple
+
+from .bus import bus
+from .db import db
+
+__all__ = ["PermissionIndex"]
+
+
+class PermissionIndex(object):
+    """
+    权限索引
+    group_id -> {(module, name), ...} 以及 user_id -> (group_id, ...)
+    分组、权限、用户分组关系变动后调用 invalidate，下次访问时重新构建
+    """
+
+    def __init__(self, manager, max_users=10000):
+        self.manager = manager
+        self.max_users = max_users
+        # 每次失效版本号加一，构建中途失效的结果将被丢弃
+        self.version = 0
+        self._group_permissions = None
+        self._user_groups = dict()
+        self._layout = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._group_permissions = None
+            self._user_groups = dict()
+
+    def find_group_ids_by_user_id(self, user_id) -> tuple:
+        group_ids = self._user_groups.get(user_id)
+        if group_ids is None:
+            version = self.version
+            group_ids = tuple(self.manager.find_group_ids_by_user_id(user_id))
+            with self._lock:
+                if version == self.version:
+                    if len(self._user_groups) >= self.max_users:
+                        self._user_groups = dict()
+                    self._user_groups[user_id] = group_ids
+        return group_ids
+
+    def find_permissions_by_group_ids(self, group_ids) -> set:
+        group_permissions = self._get_group_permissions()
+        permissions = set()
+        for group_id in group_ids:
+            permissions |= group_permissions.get(group_id, frozenset())
+        return permissions
+
+    def is_allowed(self, group_ids, meta) -> bool:
+        """分组中是否有任一分组拥有 meta 标记的权限"""
+        if meta is None:
+            return False
+        group_permissions = self._get_group_permissions()
+        key = (meta.module, meta.name)
+        for group_id in group_ids:
+            if key in group_permissions.get(group_id, ()):
+                return True
+        return False
+
+    @property
+    def layout(self) -> tuple:
+        """
+        权限位图的布局，按 (module, name) 排序后的挂载权限，及其摘要
+        代码中的权限变动(如重新部署)后摘要随之改变，旧令牌中的位图即失效
+        """
+        if self._layout is None:
+            permissions = sorted(set((meta.module, meta.name) for meta in self.manager.ep_meta.values() if meta.mount))
+            digest = hashlib.sha1("\n".join("%s.%s" % p for p in permissions).encode("utf-8")).hexdigest()[:8]
+            bits = {permission: i for i, permission in enumerate(permissions)}
+            self._layout = (bits, digest)
+        return self._layout
+
+    def get_claims(self, group_ids) -> dict:
+        """
+        将分组拥有的权限编码为位图，连同权限表版本号一起写入 access token
+        pm: 十六进制位图 pv: 权限表版本号.布局摘要
+        """
+        bits, digest = self.layout
+        # 先取版本号再读取权限，避免旧权限被标记为新版本
+        version = bus.version("permission")
+        mask = 0
+        for permission in self.find_permissions_by_group_ids(group_ids):
+            bit = bits.get(permission)
+            if bit is not None:
+                mask |= 1 << bit
+        return {"pm": format(mask, "x"), "pv": "%d.%s" % (version, digest)}
+
+    def is_allowed_by_claims(self, claims, meta) -> bool:
+        """令牌中的位图仍然有效且包含 meta 标记的权限时返回 True，否则需回退到索引鉴权"""
+        if meta is None or "pm" not in claims:
+            return False
+        bits, digest = self.layout
+        if claims.get("pv") != "%d.%s" % (bus.version("permission"), digest):
+            return False
+        bit = bits.get((meta.module, meta.name))
+        if bit is None:
+            return False
+        return bool(int(claims["pm"], 16) >> bit & 1)
+
+    def _get_group_permissions(self) -> dict:
+        group_permissions = self._group_permissions
+        if group_permissions is None:
+            version = self.version
+            group_permissions = self._load_group_permissions()
+            with self._lock:
+                if version == self.version:
+                    self._group_permissions = group_permissions
+        return group_permissions
+
+    def _load_group_permissions(self) -> dict:
+        group_permission_model = self.manager.group_permission_model
+        permission_model = self.manager.permission_model
+        rows = (
+            db.session.query(
+                group_permission_model.group_id,
+                permission_model.module,
+                permission_model.name,
+            )
+            .join(
+                permission_model,
+                permission_model.id == group_permission_model.permission_id,
+            )
+            .filter(permission_model.is_deleted == False, permission_model.mount == True)
+            .all()
+        )
+        group_permissions: Dict[int, Set[Tuple[str, str]]] = {}
+        for group_id, module, name in rows:
+            group_permissions.setdefault(group_id, set()).add((module, name))
+        return {group_id: frozenset(permissions) for group_id, permissions in group_permissions.items()}
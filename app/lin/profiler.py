@@ -0,0 +1,138 @@
+"""
+    sql profiler of Lin
+    ~~~~~~~~~
+
+    按请求统计 SQL 的执行次数、数据库耗时及归一化后的语句
+
+    统计结果记入请求日志，调试模式下附加到响应头(X-SQL-Count、X-SQL-Time)；
+    同一语句在一次请求中以不同参数重复执行多次时视为 N+1 查询并告警；
+    可通过 LOG["SLOW_QUERY"] 记录慢查询
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import re
+import time
+from functools import lru_cache
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+__all__ = ["RequestProfile", "SQLProfiler", "profiler", "normalize"]
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,?)+\)", re.I)
+_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def normalize(statement) -> str:
+    """合并空白，字面量替换为 ?，IN 列表合并为一项"""
+    statement = _SPACES.sub(" ", statement).strip()
+    statement = _LITERAL.sub("?", statement)
+    return _IN_LIST.sub("IN (?)", statement)
+
+
+class RequestProfile(object):
+    __slots__ = ("count", "duration", "statements")
+
+    def __init__(self):
+        self.count = 0
+        # 数据库耗时(秒)
+        self.duration = 0.0
+        # 归一化的语句 -> [执行次数, 耗时, 不同参数的摘要集合]
+        self.statements = dict()
+
+    def record(self, statement, parameters, duration):
+        self.count += 1
+        self.duration += duration
+        stat = self.statements.get(statement)
+        if stat is None:
+            stat = self.statements[statement] = [0, 0.0, set()]
+        stat[0] += 1
+        stat[1] += duration
+        if len(stat[2]) < 2:
+            # 只保留参数的摘要，参数中可能含有密码哈希等敏感信息
+            stat[2].add(hash(repr(parameters)))
+
+    def repeated(self, threshold):
+        """以不同参数执行次数不少于 threshold 次的语句"""
+        return [
+            (statement, stat[0])
+            for statement, stat in self.statements.items()
+            if stat[0] >= threshold and len(stat[2]) > 1
+        ]
+
+
+class SQLProfiler(object):
+    def __init__(self, app=None):
+        self.enabled = False
+        self.n_plus_one = 5
+        # 慢查询阈值(毫秒)
+        self.slow_query = None
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config.get("LOG", dict())
+        self.enabled = config.get("SQL_PROFILE", True)
+        self.n_plus_one = config.get("N_PLUS_ONE", self.n_plus_one)
+        self.slow_query = config.get("SLOW_QUERY")
+        app.extensions["sql_profiler"] = self
+        if self.enabled:
+            app.before_request(self.start)
+            app.after_request(self.finish)
+        if (self.enabled or self.slow_query is not None) and not self._listening:
+            # 监听所有引擎，包括只读副本及 db.query 使用的连接
+            event.listen(Engine, "before_cursor_execute", self._before_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_execute)
+            self._listening = True
+
+    @staticmethod
+    def start():
+        g.sql_profile = RequestProfile()
+
+    def finish(self, resp):
+        profile = g.get("sql_profile")
+        if profile is None:
+            return resp
+        for statement, times in profile.repeated(self.n_plus_one):
+            current_app.logger.warning(
+                "N+1 query in [%s] %s: executed %d times: %s",
+                request.method,
+                request.endpoint,
+                times,
+                statement,
+            )
+        if current_app.debug:
+            resp.headers["X-SQL-Count"] = str(profile.count)
+            resp.headers["X-SQL-Time"] = "%.3f" % (profile.duration * 1000)
+        return resp
+
+    @staticmethod
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        # 记在本次执行的上下文上，执行失败时随上下文丢弃
+        if context is not None:
+            context._lin_query_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_lin_query_start", None)
+        if start is None or not has_app_context():
+            return
+        duration = time.perf_counter() - start
+        profile = g.get("sql_profile")
+        if profile is not None:
+            profile.record(normalize(statement), parameters, duration)
+        if self.slow_query is not None and duration * 1000 >= self.slow_query:
+            # 不记录参数，其中可能含有密码哈希等敏感信息
+            current_app.logger.warning(
+                "slow query in %s costs:%.3f ms: %s",
+                request.endpoint if has_request_context() else "-",
+                duration * 1000,
+                normalize(statement),
+            )
+
+
+profiler = SQLProfiler()
@@ -0,0 +1,155 @@
+"""
+    query cache of Lin
+    ~~~~~~~~~
+
+    查询结果缓存，Query.cached() 标记的查询以编译后的 SQL 及参数为键缓存结果
+
+    每张表对应 invalidation bus 上的一个频道(query:表名)，缓存键中带有所涉及表的版本号；
+    会话中对某张表的写操作(ORM 的增删改及 core 层的 insert/update/delete)
+    在事务提交时递增该表的版本号，旧的缓存条目随之失效，其他进程在下次轮询时失效
+
+    通过 db.query 等原生连接执行的写操作不会使缓存失效，只能等待条目过期
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import pickle
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import Table, event, inspect
+from sqlalchemy.orm import loading
+from sqlalchemy.sql import visitors
+
+from .bus import Generation, bus
+from .cache import LRUCache
+
+__all__ = ["QueryCache", "query_cache"]
+
+TABLES_KEY = "lin_query_cache_tables"
+CHANNEL_PREFIX = "query:"
+
+
+class QueryCache(object):
+    """
+    store 需实现 get(key)、set(key, value, ttl) 及 clear()，默认为进程内的 LRUCache
+    可通过 CACHE["QUERY_STORE"] 指定一个以 (maxsize, ttl) 为参数的工厂函数替换
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        # 未开启查询缓存时，是否仍记录写过的表并递增其版本号(供计数缓存使用)
+        self.track_writes = False
+        self.ttl = 60
+        self.store = LRUCache(1024, self.ttl)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config.get("CACHE", dict())
+        self.enabled = config.get("QUERY_ENABLE", False)
+        self.ttl = config.get("QUERY_TTL", self.ttl)
+        factory = config.get("QUERY_STORE", LRUCache)
+        self.store = factory(config.get("QUERY_SIZE", 1024), self.ttl)
+        app.extensions["query_cache"] = self
+
+    def execute(self, orm_execute_state):
+        """查询命中缓存时返回缓存的结果，否则执行查询并缓存结果"""
+        session = orm_execute_state.session
+        statement = orm_execute_state.statement
+        key = self.key(session, statement, orm_execute_state.parameters)
+        if key is None:
+            return None
+        cached = self.store.get(key)
+        if cached is None:
+            frozen = orm_execute_state.invoke_statement().freeze()
+            # 缓存副本，避免会话中对实例的修改污染缓存
+            cached = pickle.dumps(frozen, pickle.HIGHEST_PROTOCOL)
+            ttl = orm_execute_state.execution_options.get("lin_cache_ttl")
+            self.store.set(key, cached, self.ttl if ttl is None else ttl)
+        else:
+            frozen = pickle.loads(cached)
+        return loading.merge_frozen_result(session, statement, frozen, load=False)()
+
+    @staticmethod
+    def key(session, statement, parameters=None):
+        """
+        以编译后的 SQL、参数及所涉及表的版本号作为缓存键
+        当前事务中写过所涉及的表时返回 None，此时需读到未提交的数据，不能使用缓存
+        """
+        tables = _tables_of(statement)
+        if tables & session.info.get(TABLES_KEY, set()):
+            return None
+        compiled = statement.compile(dialect=session.get_bind().dialect)
+        params = dict(compiled.params)
+        params.update(parameters or dict())
+        return (
+            str(compiled),
+            repr(sorted(params.items())),
+            tuple(sorted((t, bus.version(CHANNEL_PREFIX + t)) for t in tables)),
+        )
+
+    @property
+    def tracking(self) -> bool:
+        return self.enabled or self.track_writes
+
+    def clear(self):
+        self.store.clear()
+
+
+query_cache = QueryCache()
+
+
+def _tables_of(statement) -> set:
+    return {element.name for element in visitors.iterate(statement) if isinstance(element, Table)}
+
+
+def _track(session, tables):
+    tables = set(tables) - {Generation.__tablename__}
+    if tables:
+        session.info.setdefault(TABLES_KEY, set()).update(tables)
+
+
+@event.listens_for(SignallingSession, "do_orm_execute")
+def _do_orm_execute(orm_execute_state):
+    if orm_execute_state.is_select:
+        if (
+            query_cache.enabled
+            and orm_execute_state.execution_options.get("lin_cache")
+            and not orm_execute_state.is_column_load
+            and not orm_execute_state.is_relationship_load
+        ):
+            return query_cache.execute(orm_execute_state)
+        return None
+    if query_cache.tracking and (
+        orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete
+    ):
+        _track(orm_execute_state.session, _tables_of(orm_execute_state.statement))
+    return None
+
+
+@event.listens_for(SignallingSession, "after_flush")
+def _after_flush(session, flush_context):
+    if not query_cache.tracking:
+        return
+    tables = set()
+    for instance in set(session.new) | set(session.dirty) | set(session.deleted):
+        tables.update(table.name for table in inspect(instance).mapper.tables)
+    _track(session, tables)
+
+
+@event.listens_for(SignallingSession, "before_commit")
+def _publish_tables(session):
+    if not query_cache.tracking or session.in_nested_transaction():
+        return
+    # 提交前的最后一次 flush 在 before_commit 之后，先行 flush 以收集全部写过的表
+    session.flush()
+    # 各进程按相同顺序锁定频道行，避免死锁
+    for table in sorted(session.info.pop(TABLES_KEY, ())):
+        bus.publish(CHANNEL_PREFIX + table)
+
+
+@event.listens_for(SignallingSession, "after_rollback")
+def _discard_tables(session):
+    if session.in_nested_transaction():
+        return
+    session.info.pop(TABLES_KEY, None)
@@ -0,0 +1,161 @@
+"""
+    token revocation of Lin
+    ~~~~~~~~~
+
+    已注销令牌的 jti 记录在 lin_revoked_token 表中，直至令牌过期
+
+    每个进程维护一个由该表同步而来的布隆过滤器，
+    过滤器判定不存在的 jti 一定未被注销，无需查询数据库；
+    判定可能存在时才查询数据库确认
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, String, select
+
+from .bus import bus
+from .db import db
+from .interface import BaseCrud
+
+__all__ = ["RevokedToken", "BloomFilter", "RevocationList", "revocation"]
+
+# 新注销的令牌，增量同步
+CHANNEL = "revoked_token"
+# 清理过期记录后，布隆过滤器需要重建
+PURGE_CHANNEL = "revoked_token_purge"
+
+
+class RevokedToken(BaseCrud):
+    __tablename__ = "lin_revoked_token"
+
+    id = Column(Integer(), primary_key=True)
+    jti = Column(String(64), nullable=False, unique=True, comment="令牌标识")
+    expires_at = Column(DateTime, nullable=False, index=True, comment="令牌过期时间")
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        # 位数 m = -n*ln(p)/ln(2)^2，哈希函数个数 k = m/n*ln(2)
+        self.size = max(int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def _positions(self, key):
+        # 由一次哈希的两段派生出 k 个位置
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+
+class RevocationList(object):
+    def __init__(self, app=None):
+        self.capacity = 100000
+        self.error_rate = 0.001
+        self.purge_interval = 3600
+        self._bloom = None
+        # 已同步的最大记录 id
+        self._last_id = 0
+        self._stale = True
+        self._rebuild = False
+        self._purged_at = 0.0
+        self._lock = threading.Lock()
+        bus.subscribe(CHANNEL, self._mark_stale)
+        bus.subscribe(PURGE_CHANNEL, self._reset)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config.get("JWT_REVOCATION", dict())
+        self.capacity = config.get("CAPACITY", self.capacity)
+        self.error_rate = config.get("ERROR_RATE", self.error_rate)
+        self.purge_interval = config.get("PURGE_INTERVAL", self.purge_interval)
+        app.extensions["revocation"] = self
+
+    def revoke(self, jti, expires_at):
+        """
+        在当前会话的事务中注销令牌，需在 db.auto_commit() 中调用
+        expires_at 为令牌的过期时间戳，过期后记录可被清理
+        """
+        # 先递增版本号，锁住频道行，使并发注销的记录 id 按提交顺序分配，增量同步不会遗漏
+        bus.publish(CHANNEL)
+        if not self._exists(jti):
+            RevokedToken.create(jti=jti, expires_at=datetime.fromtimestamp(expires_at))
+        if time.monotonic() - self._purged_at >= self.purge_interval:
+            self.purge()
+
+    def purge(self):
+        """删除已过期令牌的记录，各进程随后重建布隆过滤器"""
+        self._purged_at = time.monotonic()
+        table = RevokedToken.__table__
+        result = db.session.execute(table.delete().where(table.c.expires_at < datetime.now()))
+        if result.rowcount > 0:
+            bus.publish(PURGE_CHANNEL)
+
+    def is_revoked(self, jti) -> bool:
+        bloom = self._sync() if self._stale else self._bloom
+        if jti not in bloom:
+            return False
+        return self._exists(jti)
+
+    @staticmethod
+    def _exists(jti) -> bool:
+        # 副本的延迟会使刚注销的令牌仍然有效，从主库读取
+        return db.session.query(db.session.query(RevokedToken.id).filter_by(jti=jti).exists()).primary().scalar()
+
+    def _sync(self) -> BloomFilter:
+        with self._lock:
+            if not self._stale:
+                return self._bloom
+            # 先清除标记，同步期间的新注销会再次标记
+            self._stale = False
+            table = RevokedToken.__table__
+            bloom, last_id = self._bloom, self._last_id
+            if self._rebuild:
+                self._rebuild = False
+                bloom, last_id = None, 0
+            rows = db.session.execute(
+                select(table.c.id, table.c.jti)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .execution_options(lin_primary=True)
+            ).all()
+            if bloom is None or bloom.count + len(rows) > bloom.capacity:
+                # 首次加载或超出容量(误判率升高)时重建
+                rows = db.session.execute(
+                    select(table.c.id, table.c.jti).order_by(table.c.id).execution_options(lin_primary=True)
+                ).all()
+                bloom = BloomFilter(max(self.capacity, len(rows) * 2), self.error_rate)
+            for id, jti in rows:
+                bloom.add(jti)
+                last_id = id
+            self._bloom, self._last_id = bloom, last_id
+            return bloom
+
+    def _mark_stale(self):
+        self._stale = True
+
+    def _reset(self):
+        # 重建前仍使用旧的过滤器，已清理的 jti 至多造成多余的查询
+        self._rebuild = True
+        self._stale = True
+
+
+revocation = RevocationList()
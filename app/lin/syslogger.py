@@ -51,6 +51,12 @@ class SysLogger:
                 request.remote_addr,
                 float(g.request_time()) * 1000,
             )
+            profile = g.get("sql_profile")
+            if profile is not None:
+                message += " sql:%d queries %.3f ms" % (
+                    profile.count,
+                    profile.duration * 1000,
+                )
             if log_config["LEVEL"] == "INFO":
                 self._app.logger.info(message)
             elif log_config["LEVEL"] == "DEBUG":
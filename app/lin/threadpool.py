@@ -0,0 +1,52 @@
+"""
+    thread pool of Lin
+    ~~~~~~~~~
+
+    在真实线程中执行 CPU 密集的函数，gevent 下使用 gevent 的线程池，
+    等待结果时只让出当前 greenlet，不阻塞事件循环
+
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ["ThreadPool", "is_gevent_patched"]
+
+
+def is_gevent_patched() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+class ThreadPool(object):
+    def __init__(self, workers=1, name="lin-pool"):
+        self.workers = workers
+        self.name = name
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def run(self, func, *args):
+        """在线程池中执行 func(*args) 并等待其结果"""
+        pool = self._get_pool()
+        if isinstance(pool, ThreadPoolExecutor):
+            return pool.submit(func, *args).result()
+        return pool.apply(func, args)
+
+    def _get_pool(self):
+        # 线程池需在 worker 进程 fork 之后创建
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                if is_gevent_patched():
+                    from gevent.threadpool import ThreadPool as GeventThreadPool
+
+                    self._pool = GeventThreadPool(self.workers)
+                else:
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix=self.name)
+            return self._pool
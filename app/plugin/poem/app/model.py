@@ -47,6 +47,7 @@ class Poem(Base):
             .filter_by(soft=False)
             .group_by(text("author"))
             .having(text("count(author) > 0"))
+            .cached()
             .all()
         )
         ret = [author[0] for author in authors]
@@ -1,4 +1,4 @@
-from typing import Any, List
+from typing import Any, List, Optional
 
 from flask import g
 from app.lin import BaseModel
@@ -7,12 +7,30 @@ from pydantic import Field
 datetime_regex = "^((([1-9][0-9][0-9][0-9]-(0[13578]|1[02])-(0[1-9]|[12][0-9]|3[01]))|(20[0-3][0-9]-(0[2469]|11)-(0[1-9]|[12][0-9]|30))) (20|21|22|23|[0-1][0-9]):[0-5][0-9]:[0-5][0-9])$"
 
 
-class BasePageSchema(BaseModel):
-    page: int
+class PageItemsSchema(BaseModel):
+    """
+    偏移分页与游标分页共有的字段
+    """
+
     count: int
+    items: List[Any]
+
+
+class BasePageSchema(PageItemsSchema):
+    page: int
     total: int
     total_page: int
-    items: List[Any]
+
+
+class CursorPageSchema(PageItemsSchema):
+    """
+    兼容偏移分页与游标分页，游标分页时 page、total_page 为空，total 只在首页返回
+    """
+
+    page: Optional[int]
+    total: Optional[int]
+    total_page: Optional[int]
+    next_cursor: Optional[str] = Field(None, description="下一页的游标，为空表示没有更多数据")
 
 
 class QueryPageSchema(BaseModel):
@@ -22,3 +40,11 @@ class QueryPageSchema(BaseModel):
     @staticmethod
     def offset_handler(req, resp, req_validation_error, instance):
         g.offset = req.context.query.count * req.context.query.page
+
+
+class ExportSchema(BaseModel):
+    format: str = Field("csv", regex="^(csv|jsonl)$", description="导出格式 csv 或 jsonl")
+
+
+class QueryCursorPageSchema(QueryPageSchema):
+    cursor: Optional[str] = Field(None, description="传入时使用游标分页，首页传空字符串")
@@ -1,11 +1,17 @@
 import base64
 import io
+import os
 import random
 import string
+import threading
+import time
+from collections import deque
 from typing import Tuple
 
 from PIL import Image, ImageDraw, ImageFont
 
+from app.lin.threadpool import ThreadPool
+
 
 class CaptchaTool:
     """
@@ -61,3 +67,77 @@ class CaptchaTool:
         self.im.save(buffered, format="webp")
         img = b"data:image/png;base64," + base64.b64encode(buffered.getvalue())
         return img, code
+
+
+class CaptchaPool:
+    """
+    预先生成的验证码池
+    后台线程每隔 refill_interval 秒至多补充 refill_batch 个验证码，池中至多保留 size 个
+    池为空时退回到当场生成
+    生成验证码是 CPU 密集的操作，gevent 下补充线程为 greenlet，
+    因此生成均放到真实线程中执行，不阻塞事件循环；
+    当场生成与补充使用不同的线程，不必等待补充的一批生成完毕
+    """
+
+    def __init__(self, size=200, refill_interval=1, refill_batch=20):
+        self.size = size
+        self.refill_interval = refill_interval
+        self.refill_batch = refill_batch
+        self._items = deque()
+        self._pid = None
+        self._refill_pool = ThreadPool(1, "captcha-refill")
+        self._render_pool = ThreadPool(1, "captcha-render")
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        config = app.config.get("LOGIN_CAPTCHA_POOL", dict())
+        self.size = config.get("SIZE", self.size)
+        self.refill_interval = config.get("REFILL_INTERVAL", self.refill_interval)
+        self.refill_batch = config.get("REFILL_BATCH", self.refill_batch)
+        app.extensions["captcha_pool"] = self
+
+    def pop(self) -> Tuple[bytes, str]:
+        """
+        取出一个验证码，每个验证码只会被取出一次
+        """
+        if self.size <= 0:
+            return self._render_pool.run(_render, 1)[0]
+        self._start_refill()
+        try:
+            return self._items.popleft()
+        except IndexError:
+            return self._render_pool.run(_render, 1)[0]
+
+    def fill(self, count=None) -> int:
+        """
+        补充至多 count 个验证码，返回实际补充的数量
+        """
+        count = self.size if count is None else count
+        count = min(count, self.size - len(self._items))
+        if count <= 0:
+            return 0
+        self._items.extend(self._refill_pool.run(_render, count))
+        return count
+
+    def _start_refill(self):
+        # 补充线程需在 worker 进程 fork 之后启动
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._items.clear()
+            threading.Thread(target=self._refill, name="captcha-pool", daemon=True).start()
+
+    def _refill(self):
+        while True:
+            self.fill(self.refill_batch)
+            time.sleep(self.refill_interval)
+
+
+def _render(count) -> list:
+    return [CaptchaTool().get_verify_code() for _ in range(count)]
+
+
+captcha_pool = CaptchaPool()
@@ -0,0 +1,4 @@
+"""
+    benchmarks of Lin-CMS-Flask
+    python -m benchmarks.<name>
+"""
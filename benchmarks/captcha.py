@@ -0,0 +1,28 @@
+"""
+    验证码生成的基准测试：当场生成 vs 从预生成的验证码池中取出
+    python -m benchmarks.captcha
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import timeit
+
+from app.util.captcha import CaptchaPool, CaptchaTool
+
+NUMBER = 2000
+
+
+def main():
+    inline = timeit.timeit(lambda: CaptchaTool().get_verify_code(), number=NUMBER)
+
+    # 补充线程不做任何事，只测量取出的开销
+    pool = CaptchaPool(size=NUMBER + 1, refill_batch=0)
+    pool.pop()
+    pool.fill()
+    pooled = timeit.timeit(pool.pop, number=NUMBER)
+
+    print("inline: %.3f ms/op" % (inline / NUMBER * 1000))
+    print("pooled: %.5f ms/op" % (pooled / NUMBER * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+    登录校验装饰器的基准测试：每次校验令牌签名 vs 缓存已验证的令牌
+    需先初始化数据库 flask db init
+    python -m benchmarks.jwt_auth
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import timeit
+
+from app import create_app
+from app.api.cms.model.group import Group
+from app.api.cms.model.group_permission import GroupPermission
+from app.api.cms.model.permission import Permission
+from app.api.cms.model.user import User
+from app.api.cms.model.user_group import UserGroup
+from app.api.cms.model.user_identity import UserIdentity
+from app.lin import get_tokens, login_required
+from app.lin.cache import LRUCache
+from app.lin.jwt import jwt
+
+NUMBER = 5000
+
+
+@login_required
+def view():
+    return None
+
+
+def main():
+    app = create_app(
+        group_model=Group,
+        user_model=User,
+        group_permission_model=GroupPermission,
+        permission_model=Permission,
+        identity_model=UserIdentity,
+        user_group_model=UserGroup,
+    )
+    with app.app_context():
+        access_token, _ = get_tokens(User.get(username="root"))
+    headers = {"Authorization": "Bearer " + access_token}
+
+    # 复用同一个请求上下文，只测量装饰器的开销
+    with app.test_request_context(headers=headers):
+        for name, size in (("uncached", 0), ("cached", 4096)):
+            jwt.token_cache = LRUCache(size)
+            view()
+            elapsed = timeit.timeit(view, number=NUMBER)
+            print("%s: %.3f ms/op" % (name, elapsed / NUMBER * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+    列表接口序列化的基准测试：按类缓存默认字段(after) vs 每个实例重新计算(before)
+    分别测量一页 1000 条日志的 init_on_load、加载及 JSON 序列化，
+    以及通过 test_client 请求日志列表接口 /cms/log
+    需先初始化数据库 flask db init
+    python -m benchmarks.serializer
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import logging
+import timeit
+
+from flask import json
+from sqlalchemy import inspect
+
+from app import create_app
+from app.api.cms.model.group import Group
+from app.api.cms.model.group_permission import GroupPermission
+from app.api.cms.model.permission import Permission
+from app.api.cms.model.user import User
+from app.api.cms.model.user_group import UserGroup
+from app.api.cms.model.user_identity import UserIdentity
+from app.lin import Log, db, get_tokens
+from app.lin.db import MixinJSONSerializer
+
+ROWS = 1000
+NUMBER = 20
+REQUESTS = 500
+# 列表接口每页至多 15 条
+PAGE = 15
+
+_PRUNE = "_MixinJSONSerializer__prune_fields"
+
+
+def _prune_fields_before(self):
+    """缓存之前的实现，每个实例都检查 mapper 并计算集合差"""
+    columns = inspect(self.__class__).columns
+    if not self._fields:
+        all_columns = set([column.name for column in columns])
+        self._fields = list(all_columns - set(self._exclude))
+
+
+def main():
+    app = create_app(
+        group_model=Group,
+        user_model=User,
+        group_permission_model=GroupPermission,
+        permission_model=Permission,
+        identity_model=UserIdentity,
+        user_group_model=UserGroup,
+    )
+    with app.app_context():
+        access_token, _ = get_tokens(User.get(username="root"))
+        # 接口在其他会话中查询，测试数据需提交，结束时删除
+        row = dict(
+            message="benchmark", user_id=1, username="root", status_code=200, method="GET", path="/", permission=""
+        )
+        Log.create_many([row] * ROWS)
+        db.session.commit()
+    headers = {"Authorization": "Bearer " + access_token}
+    # 不输出每个请求的调试日志
+    app.logger.setLevel(logging.WARNING)
+    client = app.test_client()
+
+    after = getattr(MixinJSONSerializer, _PRUNE)
+    try:
+        for mode, prune in (("before", _prune_fields_before), ("after", after)):
+            setattr(MixinJSONSerializer, _PRUNE, prune)
+            with app.app_context():
+                query = Log.query.filter_by(message="benchmark")
+
+                def load():
+                    # 清空会话，使每次查询都重新构建实例
+                    db.session.expunge_all()
+                    return query.all()
+
+                logs = load()
+                reload = timeit.timeit(lambda: [log.init_on_load() for log in logs], number=NUMBER)
+                loaded = timeit.timeit(load, number=NUMBER)
+                dumped = timeit.timeit(lambda: json.dumps(load()), number=NUMBER)
+
+            def request():
+                rv = client.get("/cms/log", headers=headers, query_string={"count": PAGE})
+                assert rv.status_code == 200
+
+            request()
+            requested = timeit.timeit(request, number=REQUESTS)
+
+            print("[%s]" % mode)
+            print("  init_on_load: %.3f ms/page" % (reload / NUMBER * 1000))
+            print("  load: %.3f ms/page" % (loaded / NUMBER * 1000))
+            print("  load + json: %.3f ms/page" % (dumped / NUMBER * 1000))
+            print("  GET /cms/log?count=%d: %.3f ms/request" % (PAGE, requested / REQUESTS * 1000))
+    finally:
+        setattr(MixinJSONSerializer, _PRUNE, after)
+        with app.app_context():
+            Log.query.filter_by(message="benchmark").delete()
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
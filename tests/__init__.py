@@ -10,6 +10,7 @@ from app.api.cms.model.permission import Permission
 from app.api.cms.model.user import User
 from app.api.cms.model.user_group import UserGroup
 from app.api.cms.model.user_identity import UserIdentity
+from app.lin import db, manager
 
 from .config import password, username
 
@@ -55,3 +56,56 @@ def get_token(key="access_token"):
     with open(get_file_path(), "r") as f:
         obj = json.loads(f.read())
         return obj[key]
+
+
+def bearer(token=None):
+    return {"Authorization": "Bearer " + (token or get_token())}
+
+
+def create_group(c, name, permission_ids=()):
+    """以超级管理员新建分组，返回分组 id"""
+    rv = c.post(
+        "/cms/admin/group",
+        headers=bearer(),
+        json={"name": name, "info": name, "permission_ids": list(permission_ids)},
+    )
+    assert rv.status_code == 200
+    with app.app_context():
+        return manager.group_model.get(name=name).id
+
+
+def create_user(c, name, group_ids=()):
+    """以超级管理员新建用户并登录，返回 (用户 id, access token)"""
+    rv = c.post(
+        "/cms/user/register",
+        headers=bearer(),
+        json={"username": name, "password": password, "confirm_password": password, "group_ids": list(group_ids)},
+    )
+    assert rv.status_code == 200
+    rv = c.post("/cms/user/login", json={"username": name, "password": password})
+    with app.app_context():
+        return manager.user_model.get(username=name).id, rv.get_json()["access_token"]
+
+
+def remove_users_and_groups(c, usernames=(), group_names=()):
+    """删除测试中新建的用户及分组，上次运行遗留的也一并删除"""
+    with app.app_context():
+        user_ids = [user.id for user in manager.user_model.query.filter(manager.user_model.username.in_(usernames))]
+    for uid in user_ids:
+        c.delete("/cms/admin/user/%d" % uid, headers=bearer())
+    # 分组的删除为软删除，同名分组再次删除时违反唯一索引，此处直接硬删除
+    with app.app_context():
+        with db.auto_commit():
+            groups = manager.group_model.query.filter(manager.group_model.name.in_(group_names)).all()
+            group_ids = [group.id for group in groups]
+            manager.group_permission_model.query.filter(manager.group_permission_model.group_id.in_(group_ids)).delete(
+                synchronize_session=False
+            )
+            for group in groups:
+                db.session.delete(group)
+            manager.invalidate_permissions()
+
+
+def permission_id(name, module):
+    with app.app_context():
+        return manager.permission_model.get(name=name, module=module).id
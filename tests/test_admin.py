@@ -2,7 +2,26 @@
     :copyright: © 2020 by the Lin team.
     :license: MIT, see LICENSE for more details.
 """
-from . import app, fixtureFunc, get_token
+import csv
+import io
+import json
+from datetime import date, datetime
+
+import pytest
+from flask_jwt_extended import decode_token
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app.lin import Log, db, manager
+from app.lin.bus import InvalidationBus
+from app.lin.log_stats import log_stats
+from app.lin.log_writer import log_writer
+from app.lin.permission import PermissionIndex
+from app.lin.profiler import profiler
+from app.lin.utils import Meta
+
+from . import app, bearer, create_group, create_user, fixtureFunc, get_token, permission_id, remove_users_and_groups
+from .config import password
 
 
 def test_permission(fixtureFunc):
@@ -18,3 +37,182 @@ def test_get_root_users(fixtureFunc):
     with app.test_client() as c:
         rv = c.get("/cms/admin/users", headers={"Authorization": "Bearer " + get_token()})
         assert rv.status_code == 200
+
+
+def test_export_users(fixtureFunc):
+    with app.test_client() as c:
+        remove_users_and_groups(c, ["export_u"])
+        uid, _ = create_user(c, "export_u")
+    try:
+        # 不使用 with，每个请求结束后不保留 g，两次请求的查询参数同名
+        rv = app.test_client().get("/cms/admin/users/export?format=csv", headers=bearer())
+        assert rv.status_code == 200
+        assert rv.mimetype == "text/csv"
+        rows = list(csv.reader(io.StringIO(rv.get_data(as_text=True).lstrip("\ufeff"))))
+        assert rows[0] == ["id", "username", "nickname", "email", "create_time"]
+        exported = {int(row[0]): row for row in rows[1:]}
+        assert exported[uid][1] == "export_u"
+        datetime.fromisoformat(exported[uid][4])
+
+        rv = app.test_client().get("/cms/admin/users/export?format=jsonl", headers=bearer())
+        assert rv.status_code == 200
+        assert rv.mimetype == "application/x-ndjson"
+        lines = rv.get_data(as_text=True).splitlines()
+        assert len(lines) == len(exported)
+        for line in lines:
+            user = json.loads(line)
+            # 两种格式的时间输出一致
+            row = [str(user["id"]), user["username"], user["nickname"] or "", user["email"] or "", user["create_time"]]
+            assert row == exported[user["id"]]
+    finally:
+        with app.test_client() as c:
+            remove_users_and_groups(c, ["export_u"])
+
+
+def test_sql_profile_headers(fixtureFunc):
+    app.debug = True
+    try:
+        with app.test_client() as c:
+            rv = c.get("/cms/admin/users", headers={"Authorization": "Bearer " + get_token()})
+            assert rv.status_code == 200
+            assert int(rv.headers["X-SQL-Count"]) > 0
+            assert float(rv.headers["X-SQL-Time"]) > 0
+    finally:
+        app.debug = False
+
+
+def test_permission_change_reaches_index(fixtureFunc):
+    # 另一个 worker 进程中的权限索引
+    other = InvalidationBus()
+    index = PermissionIndex(manager)
+    other.subscribe("permission", index.invalidate)
+    with app.app_context():
+        meta = manager.find_permission_module("查询日志统计")
+    with app.test_client() as c:
+        remove_users_and_groups(c, ["index_user"], ["index_group"])
+        try:
+            group_id = create_group(c, "index_group")
+            _, token = create_user(c, "index_user", [group_id])
+            with app.app_context():
+                other.poll(force=True)
+                assert not index.is_allowed([group_id], meta)
+            assert c.get("/cms/log/stats", headers=bearer(token)).status_code == 401
+
+            rv = c.post(
+                "/cms/admin/permission/dispatch/batch",
+                headers=bearer(),
+                json={"group_id": group_id, "permission_ids": [permission_id("查询日志统计", "日志")]},
+            )
+            assert rv.status_code == 200
+            # 本进程的索引随提交立即失效
+            assert c.get("/cms/log/stats", headers=bearer(token)).status_code == 200
+            with app.app_context():
+                # 其他进程的索引在轮询后失效
+                assert not index.is_allowed([group_id], meta)
+                other.poll(force=True)
+                assert index.is_allowed([group_id], meta)
+        finally:
+            remove_users_and_groups(c, ["index_user"], ["index_group"])
+
+
+def test_stale_permission_claims(fixtureFunc):
+    app.config["JWT_PERMISSION_CLAIMS"] = True
+    with app.app_context():
+        index = manager.permission_index
+    stats_id = permission_id("查询日志统计", "日志")
+    with app.test_client() as c:
+        remove_users_and_groups(c, ["claim_user"], ["claims_group"])
+        try:
+            group_id = create_group(c, "claims_group", [stats_id])
+            _, token = create_user(c, "claim_user", [group_id])
+            with app.app_context():
+                meta = manager.find_permission_module("查询日志统计")
+                claims = decode_token(token)
+                assert index.is_allowed_by_claims(claims, meta)
+            assert c.get("/cms/log/stats", headers=bearer(token)).status_code == 200
+
+            # 权限被收回后，旧令牌中的位图随权限表版本号失效
+            rv = c.post(
+                "/cms/admin/permission/remove",
+                headers=bearer(),
+                json={"group_id": group_id, "permission_ids": [stats_id]},
+            )
+            assert rv.status_code == 200
+            with app.app_context():
+                assert not index.is_allowed_by_claims(claims, meta)
+            assert c.get("/cms/log/stats", headers=bearer(token)).status_code == 401
+
+            # 挂载的权限变动(如重新部署)后，布局摘要改变，旧令牌中的位图失效
+            c.post(
+                "/cms/admin/permission/dispatch/batch",
+                headers=bearer(),
+                json={"group_id": group_id, "permission_ids": [stats_id]},
+            )
+            rv = c.post("/cms/user/login", json={"username": "claim_user", "password": password})
+            with app.app_context():
+                claims = decode_token(rv.get_json()["access_token"])
+                assert index.is_allowed_by_claims(claims, meta)
+                manager.ep_meta["test.layout"] = Meta("布局", "测试", True)
+                index._layout = None
+                try:
+                    assert not index.is_allowed_by_claims(claims, meta)
+                finally:
+                    del manager.ep_meta["test.layout"]
+                    index._layout = None
+                assert index.is_allowed_by_claims(claims, meta)
+        finally:
+            app.config["JWT_PERMISSION_CLAIMS"] = False
+            remove_users_and_groups(c, ["claim_user"], ["claims_group"])
+
+
+def test_slow_query_log_hides_parameters(caplog):
+    slow_query = profiler.slow_query
+    profiler.slow_query = 0
+    try:
+        with app.test_request_context():
+            # 执行失败的语句不影响之后的计时
+            with pytest.raises(OperationalError):
+                db.session.execute(text("select * from no_such_table where x = :secret"), {"secret": "pbkdf2:secret"})
+            db.session.rollback()
+            db.session.execute(text("select :secret"), {"secret": "pbkdf2:secret"})
+    finally:
+        profiler.slow_query = slow_query
+    messages = [record.getMessage() for record in caplog.records if "slow query" in record.getMessage()]
+    assert messages and not any("pbkdf2:secret" in message for message in messages)
+
+
+def test_log_stats(fixtureFunc):
+    day = datetime(2002, 3, 4, 5, 6, 7)
+    row = dict(message="stats_api", user_id=1, username="root", create_time=day)
+    log_writer.flush()
+    with app.app_context():
+        log_writer._insert(
+            [dict(row, permission="查询日志", path="/a")] * 2
+            + [dict(row, path="/b"), dict(row, path="/b", create_time=datetime(2002, 3, 5))]
+        )
+
+    def stats(**params):
+        rv = app.test_client().get("/cms/log/stats", headers=bearer(), query_string=params)
+        assert rv.status_code == 200 and rv.get_json()["dimension"] == params.get("dimension", "day")
+        return [(item["key"], item["count"]) for item in rv.get_json()["items"]]
+
+    with app.test_client() as c:
+        remove_users_and_groups(c, ["stats_user"])
+        try:
+            assert stats(dimension="day", start="2002-03-04", end="2002-03-05") == [
+                ("2002-03-04", 3),
+                ("2002-03-05", 1),
+            ]
+            assert stats(start="2002-03-05", end="2002-03-05") == [("2002-03-05", 1)]
+            assert stats(dimension="user", start="2002-03-04", end="2002-03-05") == [("root", 4)]
+            assert stats(dimension="permission", start="2002-03-04", end="2002-03-04") == [("查询日志", 2), ("", 1)]
+            assert stats(dimension="path", start="2002-03-04", end="2002-03-05", count=1) == [("/a", 2)]
+            # 没有该权限的用户
+            _, token = create_user(c, "stats_user")
+            assert c.get("/cms/log/stats", headers=bearer(token)).status_code == 401
+        finally:
+            remove_users_and_groups(c, ["stats_user"])
+            with app.app_context():
+                Log.query.filter_by(message="stats_api").delete()
+                db.session.commit()
+                log_stats.rebuild(date(2002, 3, 4), date(2002, 3, 5))
@@ -0,0 +1,25 @@
+"""
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+from app.lin import bus, db
+from app.lin.bus import InvalidationBus
+
+from . import app
+
+
+def test_publish_reaches_other_worker():
+    # 另一个 worker 进程中的 bus
+    other = InvalidationBus()
+    received = []
+    other.subscribe("test", lambda: received.append(1))
+    with app.app_context():
+        other.poll(force=True)
+        received.clear()
+        with db.auto_commit():
+            bus.publish("test")
+        other.poll()
+        assert received == []
+        other.poll(force=True)
+        assert received == [1]
+        assert other.version("test") == bus.version("test")
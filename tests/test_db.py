@@ -0,0 +1,181 @@
+"""
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+
+from app.api.v1.model.book import Book
+from app.lin import GroupPermission, Log, db
+from app.lin.count import counter
+from app.lin.db import ReplicaSet
+from app.lin.query_cache import query_cache
+
+from . import app
+
+
+def _count_checked_out():
+    counter = {"out": 0}
+
+    def checkout(*args):
+        counter["out"] += 1
+
+    def checkin(*args):
+        counter["out"] -= 1
+
+    event.listen(db.engine.pool, "checkout", checkout)
+    event.listen(db.engine.pool, "checkin", checkin)
+    return counter, lambda: (
+        event.remove(db.engine.pool, "checkout", checkout),
+        event.remove(db.engine.pool, "checkin", checkin),
+    )
+
+
+def test_query_releases_connection():
+    with app.app_context():
+        counter, remove = _count_checked_out()
+        try:
+            rows = db.query("select id, name from lin_group")
+            assert counter["out"] == 0
+            assert rows.first().name == rows.first()[1]
+
+            rows = db.query("select id, name from lin_group", stream=True)
+            assert counter["out"] == 1
+            assert len(list(rows)) > 0
+            assert counter["out"] == 0
+
+            with db.query("select id, name from lin_group", stream=True) as rows:
+                next(rows)
+            assert counter["out"] == 0
+        finally:
+            remove()
+
+
+def test_record_lookup():
+    with app.app_context():
+        rows = db.query("select id, name, name from lin_group")
+        first = rows.first()
+        assert first.id == first["id"] == first[0]
+        assert first.keys() is rows[1].keys()
+        with pytest.raises(KeyError):
+            first["name"]
+
+
+def test_to_columns():
+    with app.app_context():
+        columns = db.query("select id, name from lin_group order by id").to_columns()
+        assert columns["id"].typecode == "q"
+        assert list(columns["id"])[:2] == [1, 2]
+        assert columns["name"][:2] == ["Root", "Guest"]
+
+        with db.query("select id, create_time from lin_log", stream=True) as rows:
+            columns = rows.to_columns(batch_size=2)
+        assert len(columns["id"]) == len(columns["create_time"])
+
+
+def test_to_numpy():
+    numpy = pytest.importorskip("numpy")
+    with app.app_context():
+        columns = db.query("select id, name from lin_group order by id").to_numpy()
+        assert columns["id"].dtype == numpy.int64
+        assert columns["name"].dtype == object
+
+
+def test_bulk_writes():
+    with app.app_context():
+        try:
+            rows = [dict(group_id=9999, permission_id=i) for i in range(5)]
+            ids = GroupPermission.create_many(rows, chunk_size=2, return_pk=True)
+            # 返回的主键与写入的行一一对应
+            assert [GroupPermission.query.get(id).permission_id for id in ids] == list(range(5))
+            GroupPermission.update_many([dict(id=ids[0], permission_id=100)])
+            GroupPermission.upsert_many(
+                [
+                    dict(id=ids[1], group_id=9999, permission_id=101),
+                    dict(id=ids[-1] + 1000, group_id=9999, permission_id=102),
+                ]
+            )
+            permission_ids = sorted(gp.permission_id for gp in GroupPermission.query.filter_by(group_id=9999))
+            assert permission_ids == [2, 3, 4, 100, 101, 102]
+        finally:
+            db.session.rollback()
+
+
+def test_query_cache():
+    query_cache.enabled = True
+    try:
+        with app.app_context():
+            query = lambda: Book.query.filter_by(soft=True).cached()
+            count = len(query().all())
+            with db.auto_commit():
+                book = Book.create(title="cached", author="lin", summary="", image="")
+            assert len(query().all()) == count + 1
+            with db.auto_commit():
+                book.hard_delete()
+            assert len(query().all()) == count
+    finally:
+        query_cache.enabled = False
+
+
+def test_count_provider():
+    counter.enabled = query_cache.track_writes = True
+    try:
+        with app.app_context():
+            query = lambda: Book.query.filter_by(soft=True)
+            total = query().total("cached")
+            assert query().total("estimate") == total
+            with db.auto_commit():
+                book = Book.create(title="counted", author="lin", summary="", image="")
+            assert query().total("cached") == total + 1
+            with db.auto_commit():
+                book.hard_delete()
+            assert query().total("cached") == total
+    finally:
+        counter.enabled = query_cache.track_writes = False
+
+
+def test_read_replica(tmp_path):
+    replicas = app.extensions["replicas"]
+    with app.app_context():
+        # 副本为主库的拷贝，此后两者的写入互不可见
+        source = db.engine.raw_connection()
+        target = sqlite3.connect(str(tmp_path / "replica.db"))
+        source.connection.backup(target)
+        source.close()
+        target.execute("INSERT INTO lin_log (message, user_id, is_deleted) VALUES ('replica', 1, 0)")
+        target.commit()
+        target.close()
+    replica = db.create_replica_engine(app, "sqlite:///" + str(tmp_path / "replica.db"))
+    missing = db.create_replica_engine(app, "sqlite:///" + str(tmp_path / "no" / "db"))
+    try:
+        app.extensions["replicas"] = ReplicaSet([replica])
+        with app.app_context():
+            query = lambda message: Log.query.filter_by(message=message)
+            assert query("replica").count() == 1
+            assert query("replica").primary().count() == 0
+            with db.auto_commit():
+                Log.create(message="primary", user_id=1)
+            # 写入后读主库
+            assert query("primary").count() == 1
+        with app.app_context():
+            assert query("primary").count() == 0
+            # 副本不可用时回退到主库
+            app.extensions["replicas"] = ReplicaSet([missing])
+            assert query("replica").count() == 0
+            assert query("primary").count() == 1
+    finally:
+        app.extensions["replicas"] = replicas
+        with app.app_context():
+            with db.auto_commit():
+                Log.query.filter_by(message="primary").delete()
+
+
+def test_serializer_fields():
+    with app.app_context():
+        first, second = Log.query.limit(2).all()
+        assert first.keys() is second.keys()
+        first.hide("message").show("extra")
+        assert "message" not in first.keys() and "extra" in first.keys()
+        assert "message" in second.keys() and "extra" not in second.keys()
@@ -0,0 +1,250 @@
+"""
+    :copyright: © 2020 by the Lin team.
+    :license: MIT, see LICENSE for more details.
+"""
+import gzip
+from datetime import datetime
+
+from sqlalchemy import func
+
+from app.lin import Log, db
+from app.lin.db import encode_cursor
+from app.lin.log_retention import LogRetention, log_retention
+from app.lin.log_search import NgramIndex, log_search
+from app.lin.log_stats import log_stats
+from app.lin.log_writer import log_writer
+
+from . import app, bearer, fixtureFunc
+
+
+def test_seek():
+    with app.app_context():
+        try:
+            now = datetime(2020, 1, 1)
+            # create_time 相同时按 id 区分
+            Log.create_many([dict(message="seek", user_id=1, create_time=now) for _ in range(5)])
+            query = Log.query.filter_by(message="seek")
+            seen, cursor = [], ""
+            while cursor is not None:
+                items, cursor = query.seek(cursor, 2, Log.create_time, Log.id)
+                seen.extend(log.id for log in items)
+            assert seen == sorted(seen, reverse=True)
+            assert len(seen) == len(set(seen)) == 5
+        finally:
+            db.session.rollback()
+
+
+def test_cursor_pagination(fixtureFunc):
+    rv = app.test_client().get("/cms/log?count=2&cursor=", headers=bearer())
+    assert rv.status_code == 200
+    page = rv.get_json()
+    assert len(page["items"]) == 2 and page["total"] >= 2 and page["next_cursor"]
+
+    rv = app.test_client().get("/cms/log?count=2&cursor=" + page["next_cursor"], headers=bearer())
+    assert rv.status_code == 200
+    assert rv.get_json()["total"] is None
+    assert rv.get_json()["items"][0]["time"] <= page["items"][-1]["time"]
+
+    # 格式错误的游标返回参数错误，而不是在查询时出错
+    for cursor in ("!!!", encode_cursor([1]), encode_cursor([[1], 2])):
+        rv = app.test_client().get("/cms/log?count=2&cursor=" + cursor, headers=bearer())
+        assert rv.status_code == 400
+
+
+def test_log_total_uses_count_mode(fixtureFunc):
+    # 默认的 COUNT_MODE 为 exact，日志总数不使用估算值
+    log_writer.flush()
+    with app.app_context():
+        expected = Log.query.count()
+    rv = app.test_client().get("/cms/log?count=1", headers=bearer())
+    assert rv.status_code == 200
+    assert rv.get_json()["total"] == expected
+
+
+def test_log_search():
+    # 等待其他用例的日志写入完成
+    log_writer.flush()
+    with app.app_context():
+        resolved, index = log_search.resolve(), log_search.index
+        # 窗口小于日志总数，窗口之外的日志以 like 检索
+        log_search.index = NgramIndex(window=Log.query.count() // 2)
+        try:
+            for keyword in ("登录成功", "oot登", "令", "ROOT"):
+                expected = {log.id for log in Log.query.filter(Log.message.like(f"%{keyword}%"))}
+                for backend in ("fts5", "python", "like"):
+                    log_search._resolved = backend
+                    query, _ = log_search.search(Log.query, keyword)
+                    assert {log.id for log in query} == expected, (backend, keyword)
+            assert log_search.index.floor > 0
+            assert all(id > log_search.index.floor for ids in log_search.index._postings.values() for id in ids)
+        finally:
+            log_search._resolved, log_search.index = resolved, index
+
+
+def test_log_search_late_commit():
+    log_writer.flush()
+    with app.app_context():
+        index = NgramIndex()
+        try:
+            late, last = Log.create_many(
+                [dict(message="晚提交的日志", user_id=1), dict(message="lastlog", user_id=1)], return_pk=True
+            )
+            db.session.commit()
+            # 模拟 id 较小的日志晚于 id 较大的日志提交
+            row = Log.query.filter_by(id=late).first()
+            Log.query.filter_by(id=late).delete()
+            db.session.commit()
+            index.sync()
+            assert late in index._gaps and last not in index._gaps
+            Log.create_many([dict(id=late, message="晚提交的日志", user_id=1, create_time=row.create_time)])
+            db.session.commit()
+            index.sync()
+            assert late not in index._gaps and late in index.candidates("晚提交")
+            query = Log.query.filter(index.condition("晚提交"), Log.message.like("%晚提交%"))
+            assert [log.id for log in query] == [late]
+            # 超时的空缺视为已回滚
+            index._gaps[last + 1000] = 0
+            index.sync()
+            assert last + 1000 not in index._gaps
+            # 候选超过 IN 的参数个数上限时使用 like
+            index._gaps.update(dict.fromkeys(range(last + 1, last + 1000), 1e18))
+            assert index.candidates("晚提交") is None and index.condition("晚提交") is None
+        finally:
+            Log.query.filter(Log.message.in_(["晚提交的日志", "lastlog"])).delete(synchronize_session=False)
+            db.session.commit()
+
+
+def test_log_retention(tmp_path):
+    log_writer.flush()
+    with app.app_context():
+        Log.create_many(
+            [dict(message="retention", user_id=1, username="root", create_time=datetime(2000, 1, 15))] * 3
+            + [dict(message="retention", user_id=1, username="root", create_time=datetime(2000, 3, 1))]
+        )
+        db.session.commit()
+        archive_dir = log_retention.archive_dir
+        log_retention.archive_dir = str(tmp_path)
+        try:
+            # 已存在的归档不被覆盖
+            (tmp_path / "lin_log-2000-01.jsonl.gz").write_bytes(b"old")
+            result = log_retention.retain()
+            # 没有日志的月份不归档
+            assert {month.strftime("%Y-%m"): count for month, _, count in result} == {"2000-01": 3, "2000-03": 1}
+            assert (tmp_path / "lin_log-2000-01.jsonl.gz").read_bytes() == b"old"
+            assert not (tmp_path / "lin_log-2000-02.jsonl.gz").exists()
+            with gzip.open(tmp_path / "lin_log-2000-01.1.jsonl.gz", "rt") as f:
+                assert len(f.read().splitlines()) == 3
+            assert Log.query.filter_by(message="retention").count() == 0
+
+            # 只删除已归档的日志，归档后写入的日志保留
+            Log.create_many([dict(message="retention", user_id=1, create_time=datetime(2000, 1, 20))] * 2)
+            db.session.commit()
+            path, count, last_id = log_retention.archive(datetime(2000, 1, 1))
+            assert path.endswith("lin_log-2000-01.2.jsonl.gz") and count == 2
+            Log.create_log(message="retention", user_id=1, create_time=datetime(2000, 1, 25), commit=True)
+            log_retention.purge(datetime(2000, 1, 1), last_id)
+            assert [log.id > last_id for log in Log.query.filter_by(message="retention")] == [True]
+        finally:
+            log_retention.archive_dir = archive_dir
+            Log.query.filter_by(message="retention").delete()
+            db.session.commit()
+
+
+class _Result(list):
+    def scalars(self):
+        return self
+
+    def scalar(self):
+        return self[0] if self else None
+
+
+def _retention(monkeypatch, dialect, rows=()):
+    """不连接数据库，记录生成的 DDL"""
+    retention = LogRetention()
+    statements = []
+    monkeypatch.setattr(LogRetention, "dialect", dialect)
+    monkeypatch.setattr(retention, "_execute_ddl", statements.extend)
+    monkeypatch.setattr(db.session, "execute", lambda *args, **kwargs: _Result(rows))
+    return retention, statements
+
+
+def test_partition_names(monkeypatch):
+    retention, _ = _retention(monkeypatch, "mysql", ["p200001", "p200012", "pmax"])
+    assert retention.partitions() == {datetime(2000, 1, 1): "p200001", datetime(2000, 12, 1): "p200012"}
+    retention, _ = _retention(monkeypatch, "postgresql", ["lin_log_p200001", "lin_log_default"])
+    assert retention.partitions() == {datetime(2000, 1, 1): "lin_log_p200001"}
+    retention, _ = _retention(monkeypatch, "sqlite", ["p200001"])
+    assert retention.partitions() == {}
+
+
+def test_partition_ddl(monkeypatch):
+    months = [datetime(2000, 12, 1), datetime(2001, 1, 1)]
+    retention, statements = _retention(monkeypatch, "postgresql")
+    retention._convert_postgresql(months)
+    assert statements[:3] == [
+        "ALTER TABLE lin_log RENAME TO lin_log_legacy",
+        "CREATE TABLE lin_log (LIKE lin_log_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (create_time)",
+        "ALTER TABLE lin_log ADD PRIMARY KEY (id, create_time)",
+    ]
+    assert statements[3:5] == [
+        "CREATE TABLE lin_log_p200012 PARTITION OF lin_log FOR VALUES FROM ('2000-12-01') TO ('2001-01-01')",
+        "CREATE TABLE lin_log_p200101 PARTITION OF lin_log FOR VALUES FROM ('2001-01-01') TO ('2001-02-01')",
+    ]
+    # 先建立默认分区再迁移数据，超出分区范围的日志进入默认分区
+    assert statements.index("CREATE TABLE lin_log_default PARTITION OF lin_log DEFAULT") < statements.index(
+        "INSERT INTO lin_log SELECT * FROM lin_log_legacy"
+    )
+    assert statements[-2:] == ["DROP TABLE lin_log_legacy", "CREATE INDEX create_time_id ON lin_log (create_time, id)"]
+
+    # 默认分区中已有该月的日志时，分离默认分区后建立分区并移入该月的日志
+    del statements[:]
+    retention._add_partition(datetime(2001, 2, 1))
+    condition = "create_time >= '2001-02-01' AND create_time < '2001-03-01'"
+    assert statements == [
+        "ALTER TABLE lin_log DETACH PARTITION lin_log_default",
+        "CREATE TABLE lin_log_p200102 PARTITION OF lin_log FOR VALUES FROM ('2001-02-01') TO ('2001-03-01')",
+        "INSERT INTO lin_log SELECT * FROM lin_log_default WHERE " + condition,
+        "DELETE FROM lin_log_default WHERE " + condition,
+        "ALTER TABLE lin_log ATTACH PARTITION lin_log_default DEFAULT",
+    ]
+
+    retention, statements = _retention(monkeypatch, "postgresql", ["lin_log_p200012"])
+    retention._drop_partition(datetime(2000, 12, 1))
+    assert statements == ["DROP TABLE lin_log_p200012"]
+
+    retention, statements = _retention(monkeypatch, "mysql", ["p200012", "pmax"])
+    retention._add_partition(datetime(2001, 1, 1))
+    retention._drop_partition(datetime(2000, 12, 1))
+    assert statements == [
+        "ALTER TABLE lin_log REORGANIZE PARTITION pmax INTO "
+        "(PARTITION p200101 VALUES LESS THAN (TO_DAYS('2001-02-01')), PARTITION pmax VALUES LESS THAN MAXVALUE)",
+        "ALTER TABLE lin_log DROP PARTITION p200012",
+    ]
+
+
+def test_log_stats():
+    log_writer.flush()
+    with app.app_context():
+        day = datetime(2001, 2, 3, 4, 5, 6)
+        # 汇总随批量写入累加，同步写入时同样计入
+        log_writer._insert([dict(message="stats", user_id=1, username="root", path="/a", create_time=day)] * 2)
+        log_writer._write_now(dict(message="stats", user_id=1, username="root", create_time=day))
+        try:
+            assert log_stats.query("day", day.date(), day.date()) == [(day.date(), 3)]
+            assert log_stats.query("path", day.date(), day.date(), 10) == [("/a", 2), ("", 1)]
+            # 单独写入日志不更新汇总
+            Log.create_log(message="stats", user_id=1, username="root", create_time=day, commit=True)
+            assert log_stats.query("day", day.date(), day.date()) == [(day.date(), 3)]
+            # 重建后与按日志统计的结果一致，软删除的日志同样计入
+            Log.query.filter_by(message="stats").first().delete(commit=True)
+            log_stats.rebuild()
+            assert log_stats.query("day", day.date(), day.date()) == [(day.date(), 4)]
+            username = func.coalesce(Log.username, "")
+            expected = dict(db.session.query(username, func.count()).group_by(username))
+            # 更早的汇总对应的日志已删除，不参与比较
+            oldest = db.session.query(func.min(Log.create_time)).scalar().date()
+            assert dict(log_stats.query("user", oldest, count=100)) == expected
+        finally:
+            Log.query.filter_by(message="stats").delete()
+            db.session.commit()
+            log_stats.rebuild(day.date(), day.date())
@@ -4,7 +4,23 @@
 """
 
 
-from . import app, fixtureFunc, get_token  # type: ignore
+import hashlib
+import os
+import threading
+import time
+from datetime import timedelta
+
+from flask_jwt_extended import create_access_token
+
+from app.lin import Log, manager
+from app.lin.bus import InvalidationBus
+from app.lin.cache import LRUCache
+from app.lin.jwt import SCOPE, jwt
+from app.lin.log_writer import log_writer
+from app.util.captcha import CaptchaPool
+
+from . import app, bearer, create_user, fixtureFunc, get_token, remove_users_and_groups  # type: ignore
+from .config import password, username
 
 
 def test_change_nickname(fixtureFunc):
@@ -15,3 +31,113 @@ def test_change_nickname(fixtureFunc):
             json={"nickname": "tester"},
         )
         assert rv.status_code == 200
+
+
+def test_logout_revokes_tokens(fixtureFunc):
+    with app.test_client() as c:
+        headers = {"Authorization": "Bearer " + get_token()}
+        rv = c.post("/cms/user/logout", headers=headers, json={"refresh_token": get_token("refresh_token")})
+        assert rv.status_code == 200
+        rv = c.get("/cms/user/information", headers=headers)
+        assert rv.status_code == 401
+        rv = c.get("/cms/user/refresh", headers={"Authorization": "Bearer " + get_token("refresh_token")})
+        assert rv.status_code != 200
+
+
+def test_log_writer(fixtureFunc):
+    log_writer.flush()
+    with app.app_context():
+        before = Log.query.filter_by(username=username).count()
+    for sync in (False, True):
+        log_writer.sync = sync
+        try:
+            with app.test_client() as c:
+                rv = c.post("/cms/user/login", json={"username": username, "password": password})
+                assert rv.status_code == 200
+        finally:
+            log_writer.sync = False
+    log_writer.flush()
+    with app.app_context():
+        assert Log.query.filter_by(username=username).count() == before + 2
+
+
+def test_user_cache_eviction(fixtureFunc):
+    # 另一个 worker 进程中的用户缓存
+    other = InvalidationBus()
+    other_cache = LRUCache()
+    other.subscribe("user", other_cache.clear)
+    with app.test_client() as c:
+        remove_users_and_groups(c, ["evict_user"])
+        try:
+            uid, token = create_user(c, "evict_user")
+            assert c.get("/cms/user/information", headers=bearer(token)).status_code == 200
+            with app.app_context():
+                user_cache = manager.user_cache
+                other.poll(force=True)
+            assert uid in user_cache
+            other_cache.set(uid, user_cache.get(uid))
+
+            # 修改密码后快照失效
+            rv = c.put(
+                "/cms/admin/user/%d/password" % uid,
+                headers=bearer(),
+                json={"new_password": "654321", "confirm_password": "654321"},
+            )
+            assert rv.status_code == 200
+            assert uid not in user_cache
+            assert c.get("/cms/user/information", headers=bearer(token)).status_code == 200
+            assert uid in user_cache
+
+            # 删除后本进程立即失效，其他进程在轮询后失效，令牌不能再取得用户
+            assert c.delete("/cms/admin/user/%d" % uid, headers=bearer()).status_code == 200
+            assert uid not in user_cache
+            assert uid in other_cache
+            with app.app_context():
+                other.poll(force=True)
+            assert uid not in other_cache
+            assert c.get("/cms/user/information", headers=bearer(token)).status_code == 404
+        finally:
+            remove_users_and_groups(c, ["evict_user"])
+
+
+def test_token_cache_rejects_revoked_and_expired(fixtureFunc):
+    with app.test_client() as c:
+        with app.app_context():
+            token = create_access_token(dict(uid=1, scope=SCOPE), expires_delta=timedelta(seconds=3))
+        key = hashlib.sha256(token.encode("utf-8")).digest()
+        assert c.get("/cms/user/information", headers=bearer(token)).status_code == 200
+        assert key in jwt.token_cache
+        # 条目随令牌过期，过期的令牌不会从缓存中取得
+        time.sleep(4)
+        assert key not in jwt.token_cache
+        rv = c.get("/cms/user/information", headers=bearer(token))
+        assert rv.status_code == 422 and rv.get_json()["code"] == 10051
+
+        # 注销后即使令牌内容仍在缓存中也不能再使用
+        headers = bearer()
+        assert c.get("/cms/user/information", headers=headers).status_code == 200
+        assert hashlib.sha256(get_token().encode("utf-8")).digest() in jwt.token_cache
+        rv = c.post("/cms/user/logout", headers=headers, json={"refresh_token": get_token("refresh_token")})
+        assert rv.status_code == 200
+        rv = c.get("/cms/user/information", headers=headers)
+        assert rv.status_code == 401 and rv.get_json()["code"] == 10043
+
+
+def test_captcha_pool():
+    pool = CaptchaPool(size=3)
+    assert pool.fill() == 3 and pool.fill() == 0
+    image, code = pool._items[0]
+    assert image.startswith(b"data:image") and len(code) == 4
+
+    # 补充的线程繁忙时，池为空仍可当场生成
+    pool._items.clear()
+    pool._pid = os.getpid()
+    release = threading.Event()
+    busy = threading.Thread(target=pool._refill_pool.run, args=(release.wait,))
+    busy.start()
+    try:
+        image, code = pool.pop()
+        assert image.startswith(b"data:image") and len(code) == 4
+    finally:
+        release.set()
+        busy.join()